@@ -14,7 +14,7 @@ from django.db import transaction
 from jobs.models import HDXExportRegion, Job, SavedFeatureSelection, validate_aoi, validate_mbtiles, PartnerExportRegion
 from rest_framework import serializers
 from rest_framework_gis import serializers as geo_serializers
-from tasks.models import ExportRun, ExportTask
+from tasks.models import ExportRun, ExportRunStage, ExportTask
 
 # Get an instance of a logger
 LOG = logging.getLogger(__name__)
@@ -33,8 +33,16 @@ class ExportTaskSerializer(serializers.ModelSerializer):
                   'duration', 'filesize_bytes', 'download_urls')
 
 
+class ExportRunStageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ExportRunStage
+        fields = ('name', 'started_at', 'duration', 'bytes_in', 'bytes_out',
+                  'peak_rss', 'failed', 'detail')
+
+
 class ExportRunSerializer(serializers.ModelSerializer):
     tasks = ExportTaskSerializer(many=True, read_only=True)
+    stages = ExportRunStageSerializer(many=True, read_only=True)
     user = UserSerializer(
         read_only=True, default=serializers.CurrentUserDefault())
 
@@ -42,7 +50,7 @@ class ExportRunSerializer(serializers.ModelSerializer):
         model = ExportRun
         lookup_field = 'uid'
         fields = ('uid','created_at', 'started_at', 'finished_at', 'duration',
-                  'elapsed_time', 'user', 'size','hdx_sync_status', 'status', 'tasks')
+                  'elapsed_time', 'user', 'size', 'format_sizes', 'hdx_sync_status', 'status', 'tasks', 'stages')
 
 
 class ConfigurationSerializer(serializers.ModelSerializer):
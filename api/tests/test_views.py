@@ -317,3 +317,53 @@ class TestHDXExportRegionViewSet(APITestCase):
 
 
 
+
+
+class TestUpstreamTimestamps(unittest.TestCase):
+
+    @patch('api.views.requests.get')
+    @patch('api.views.metrics_redis')
+    def test_fetches_live_without_redis(self, metrics_redis, get):
+        import redis
+        from api.views import upstream_timestamps
+        metrics_redis.return_value.get.side_effect = redis.ConnectionError()
+        get.return_value.content = b'2026-10-18T10:00:00Z'
+        get.return_value.json.return_value = {'lastUpdated': '2026-10-18T09:00:00Z'}
+        timestamps = upstream_timestamps()
+        self.assertEqual(timestamps['overpass'], '2026-10-18T10:00:00+00:00')
+        self.assertEqual(timestamps['rawdata_api'], '2026-10-18T09:00:00+00:00')
+        metrics_redis.return_value.setex.assert_not_called()
+
+
+class TestEstimate(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='demo', email='demo@demo.com', password='demo')
+        self.token = Token.objects.create(user=self.user)
+        self.url = '/api/estimate'
+        self.request_data = {
+            'the_geom': {'type': 'Polygon', 'coordinates': [[
+                [-10.80029, 6.3254236], [-10.79809, 6.3254236], [-10.79809, 6.32752],
+                [-10.80029, 6.32752], [-10.80029, 6.3254236]]]},
+            'export_formats': ['shp'],
+        }
+
+    def test_requires_authentication(self):
+        response = self.client.post(self.url, self.request_data, format='json')
+        self.assertIn(response.status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+
+    @patch('tasks.estimates.format_models', return_value={})
+    def test_token_client(self, format_models):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        response = self.client.post(self.url, self.request_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['formats'], {'shp': {'size_bytes': None, 'duration_seconds': None}})
+        self.assertIn('nodes', response.data)
+
+    def test_invalid_request(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        response = self.client.post(self.url, {'export_formats': ['shp']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.request_data['export_formats'] = ['not_a_format']
+        response = self.client.post(self.url, self.request_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
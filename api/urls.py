@@ -6,7 +6,7 @@ from rest_framework.routers import DefaultRouter
 
 from .views import (ConfigurationViewSet, ExportRunViewSet,
                     HDXExportRegionViewSet, PartnerExportRegionViewSet, JobViewSet, permalink, get_overpass_timestamp,
-                    cancel_run, get_user_permissions, request_geonames, get_overpass_status, get_groups, stats, run_stats, request_nominatim,machine_status)
+                    cancel_run, get_user_permissions, request_geonames, get_overpass_status, get_groups, stats, run_stats, request_nominatim,machine_status,metrics,estimate)
 
 router = DefaultRouter(trailing_slash=False)
 router.register(r'jobs', JobViewSet, base_name='jobs')
@@ -33,9 +33,11 @@ urlpatterns += [
     url(r'^overpass_status$', get_overpass_status),
     url(r'^permissions$', get_user_permissions),
     url(r'^groups$',get_groups),
+    url(r'^estimate$', estimate),
     url(r'^stats$', stats),
     url(r'^run_stats$', run_stats),
     url(r'^status$', machine_status),
+    url(r'^metrics$', metrics),
     url(r'^cancel_run$', cancel_run),
 
 ]
@@ -1,26 +1,26 @@
 """Provides classes for handling API requests."""
 # -*- coding: utf-8 -*-
 from distutils.util import strtobool
-import itertools
 from itertools import chain
 import logging
 import json
 from django.utils import timezone
 from datetime import datetime, timedelta
-from collections import Counter
 import os
 import io
 import csv
 import dateutil.parser
+import hmac
+import redis
 import requests
 from cachetools.func import ttl_cache
-from django.contrib.auth.models import User
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import Permission
 from django.contrib.auth.models import Group
-from django.contrib.gis.geos import GEOSGeometry, Polygon
-from django.db.models import Q
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSException, GEOSGeometry, Polygon
+from django.db.models import Case, Count, DateTimeField, F, Max, Q, When
 from django.http import (
     JsonResponse,
     HttpResponse,
@@ -29,9 +29,17 @@ from django.http import (
 )
 from django.views.decorators.http import require_http_methods
 from django.core.exceptions import ValidationError as DjangoValidationError
-from jobs.models import HDXExportRegion, PartnerExportRegion, Job, SavedFeatureSelection
+from jobs.models import (
+    HDXExportRegion,
+    PartnerExportRegion,
+    Job,
+    SavedFeatureSelection,
+    check_extent,
+    validate_export_formats,
+    validate_feature_selection,
+)
 from rest_framework import filters, permissions, status, viewsets
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import api_view, detail_route, permission_classes
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.serializers import ValidationError
@@ -46,15 +54,17 @@ from api.serializers import (
     PartnerExportRegionSerializer,
     JobSerializer,
 )
+from tasks.estimates import estimate_export
 from tasks.models import ExportRun, ExportTask
+from tasks.rollups import by_period, daily_stats
+from tasks.metrics import latest as collected_metrics, redis_client as metrics_redis
 from tasks.task_runners import ExportTaskRunner
 
 from .permissions import IsHDXAdmin, IsOwnerOrReadOnly, IsMemberOfGroup
 from .renderers import HOTExportApiRenderer
 
 from hdx_exports.hdx_export_set import sync_region
-from rtree import index
-import psutil
+from utils.system_sampler import latest_sample
 
 # Get an instance of a logger
 LOG = logging.getLogger(__name__)
@@ -62,14 +72,6 @@ LOG = logging.getLogger(__name__)
 # controls how api responses are rendered
 renderer_classes = (JSONRenderer, HOTExportApiRenderer)
 
-DIR = os.path.dirname(os.path.abspath(__file__))
-try:
-    idx = index.Rtree(os.path.join(DIR, "reverse_geocode"))
-except Exception as ex:
-    # pass
-    raise ex
-
-
 def bbox_to_geom(s):
     try:
         return GEOSGeometry(Polygon.from_bbox(s.split(",")), srid=4326)
@@ -238,7 +240,7 @@ class ExportRunViewSet(viewsets.ModelViewSet):
         """
         Get a single Export Run.
         """
-        queryset = ExportRun.objects.filter(uid=uid)
+        queryset = ExportRun.objects.filter(uid=uid).prefetch_related("tasks", "stages")
         serializer = self.get_serializer(
             queryset, many=True, context={"request": request}
         )
@@ -250,7 +252,9 @@ class ExportRunViewSet(viewsets.ModelViewSet):
         """
         job_uid = self.request.query_params.get("job_uid", None)
         queryset = self.filter_queryset(
-            ExportRun.objects.filter(job__uid=job_uid).order_by("-started_at")
+            ExportRun.objects.filter(job__uid=job_uid)
+            .prefetch_related("tasks", "stages")
+            .order_by("-started_at")
         )
         serializer = self.get_serializer(
             queryset, many=True, context={"request": request}
@@ -277,7 +281,10 @@ class HDXExportRegionViewSet(viewsets.ModelViewSet):
         if schedule_period not in [None, "any"]:
             queryset = queryset.filter(Q(schedule_period=schedule_period))
 
-        return queryset.prefetch_related("job__runs__tasks").defer("job__the_geom")
+        return (
+            queryset.select_related("job__latest_run", "job__latest_finished_run")
+            .defer("job__the_geom")
+        )
 
     def get_serializer_class(self):
         if self.action == "list":
@@ -316,7 +323,7 @@ class PartnerExportRegionViewSet(viewsets.ModelViewSet):
         group_ids = self.request.user.groups.values_list("id")
         return (
             PartnerExportRegion.objects.filter(deleted=False, group_id__in=group_ids)
-            .prefetch_related("job__runs__tasks")
+            .select_related("job__latest_run", "job__latest_finished_run")
             .defer("job__the_geom")
         )
 
@@ -342,12 +349,24 @@ def permalink(request, uid):
         return HttpResponseNotFound()
 
 
+def stats_range(request):
+    """before and after from the query string as aware datetimes; the last day by default."""
+    now = timezone.now()
+    times = []
+    for name, default in (("before", now), ("after", now - timedelta(days=1))):
+        value = request.GET.get(name)
+        value = dateutil.parser.parse(value) if value else default
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        times.append(value)
+    return times
+
+
 @require_http_methods(["GET"])
 def stats(request):
     if not request.user.is_superuser:
         return HttpResponseForbidden()
-    before = request.GET.get("before", timezone.now())
-    after = request.GET.get("after", timezone.now() - timedelta(days=1))
+    before, after = stats_range(request)
     period = request.GET.get("period", "day")
     is_csv = request.GET.get("csv", False) == "true"
 
@@ -368,45 +387,28 @@ def stats(request):
     elif period == "month":
         period_fn = toMonth
 
-    users = (
-        User.objects.only("date_joined")
-        .filter(date_joined__gte=after, date_joined__lte=before)
-        .order_by("-date_joined")
-    )
-
-    grouped_users_by_period = {}
-    for gu in itertools.groupby(users, lambda u: period_fn(u.date_joined)):
-        grouped_users_by_period[gu[0]] = len(list(gu[1]))
-
-    queryset = Job.objects.only("created_at", "the_geom").order_by("-created_at")
-    if before:
-        queryset = queryset.filter(Q(created_at__lte=before))
-    if after:
-        queryset = queryset.filter(Q(created_at__gte=after))
-
-    grouped_jobs = itertools.groupby(queryset, lambda j: period_fn(j.created_at))
+    queryset = Job.objects.filter(created_at__gte=after, created_at__lte=before)
+    geoms = [
+        [c.x, c.y]
+        for c in queryset.exclude(centroid=None)
+        .order_by("-created_at")
+        .values_list("centroid", flat=True)
+    ]
 
-    geoms = []
+    grouped = by_period(daily_stats(after, before), period_fn)
     periods = []
-    for x in grouped_jobs:
-        top_regions = Counter()
-        jobs_in_group = list(x[1])
-        for j in jobs_in_group:
-            centroid = j.the_geom.centroid
-            geoms.append([centroid.x, centroid.y])
-            result = next(idx.nearest((centroid.x, centroid.y), 1, objects=True))
-            top_regions[result.object[2]] += 1
-
-        users_in_period = grouped_users_by_period.get(x[0], 0)
-
+    for p in sorted(grouped, reverse=True):
+        stats = grouped[p]
+        if not stats["jobs_count"]:
+            continue
         top_regions_string = " ".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in top_regions.most_common(5)]
+            ["{0}:{1}".format(x[0], x[1]) for x in stats["regions"].most_common(5)]
         )
         periods.append(
             {
-                "start_date": x[0],
-                "jobs_count": len(jobs_in_group),
-                "users_count": users_in_period,
+                "start_date": p,
+                "jobs_count": stats["jobs_count"],
+                "users_count": stats["users_count"],
                 "top_regions": top_regions_string,
             }
         )
@@ -433,8 +435,7 @@ def stats(request):
 def run_stats(request):
     if not request.user.is_superuser:
         return HttpResponseForbidden()
-    before = request.GET.get("before", timezone.now())
-    after = request.GET.get("after", timezone.now() - timedelta(days=1))
+    before, after = stats_range(request)
     period = request.GET.get("period", "day")
     is_csv = request.GET.get("csv", False) == "true"
 
@@ -455,55 +456,29 @@ def run_stats(request):
     elif period == "month":
         period_fn = toMonth
 
-    run_queryset = ExportRun.objects.only("started_at", "status").order_by(
-        "-started_at"
-    )
-
-    if before:
-        run_queryset = run_queryset.filter(Q(started_at__lte=before))
-    if after:
-        run_queryset = run_queryset.filter(Q(started_at__gte=after))
-
-    grouped_runs = itertools.groupby(run_queryset, lambda j: period_fn(j.started_at))
-
+    grouped = by_period(daily_stats(after, before), period_fn)
     periods = []
-    for x in grouped_runs:
-        run_types = Counter()
-        export_formats = Counter()
-        hdx_run_status = Counter()
-        normal_run_status = Counter()
-        runs_in_group = list(x[1])
-        for j in runs_in_group:
-            result = j.is_hdx
-            if result is True:
-                result = "hdx_run"
-                hdx_status = j.status
-                hdx_run_status[hdx_status.lower()] += 1
-            else:
-                result = "on_demand"
-                normal_status = j.status
-                normal_run_status[normal_status.lower()] += 1
-            run_types[result] += 1
-            export_format = j.export_formats
-            for f in export_format:
-                export_formats[str(f)] += 1
+    for p in sorted(grouped, reverse=True):
+        stats = grouped[p]
+        if not stats["runs_count"]:
+            continue
         run_types_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in run_types.most_common(5)]
+            ["{0}:{1}".format(x[0], x[1]) for x in stats["run_types"].most_common(5)]
         )
         export_formats_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in export_formats.most_common(10)]
+            ["{0}:{1}".format(x[0], x[1]) for x in stats["export_formats"].most_common(10)]
         )
         hdx_run_status_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in hdx_run_status.most_common(4)]
+            ["{0}:{1}".format(x[0], x[1]) for x in stats["hdx_run_status"].most_common(4)]
         )
         normal_run_status_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in normal_run_status.most_common(4)]
+            ["{0}:{1}".format(x[0], x[1]) for x in stats["normal_run_status"].most_common(4)]
         )
 
         periods.append(
             {
-                "start_date": x[0],
-                "runs_count": len(runs_in_group),
+                "start_date": p,
+                "runs_count": stats["runs_count"],
                 "run_types": run_types_string,
                 "hdx_run_status": hdx_run_status_string,
                 "normal_run_status": normal_run_status_string,
@@ -773,6 +748,35 @@ def get_groups(request):
     return JsonResponse({"groups": groups})
 
 
+@api_view(["POST"])
+@permission_classes((permissions.IsAuthenticated,))
+def estimate(request):
+    """Estimated nodes, tiles, output size and duration of a prospective export."""
+    body = request.data
+    try:
+        geom = GEOSGeometry(json.dumps(body["the_geom"]), srid=4326)
+        export_formats = body.get("export_formats") or []
+        validate_export_formats(export_formats)
+        if body.get("feature_selection"):
+            validate_feature_selection(body["feature_selection"])
+        result = check_extent(geom, settings.OVERPASS_API_URL)
+        if not result.valid:
+            raise DjangoValidationError(result.message, params=result.params)
+    except (ValueError, KeyError, TypeError, AttributeError, GEOSException, GDALException) as e:
+        return Response({"error": "Invalid request: {0}".format(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except DjangoValidationError as e:
+        return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(
+        estimate_export(
+            geom,
+            export_formats,
+            body.get("mbtiles_minzoom"),
+            body.get("mbtiles_maxzoom"),
+        )
+    )
+
+
 from dramatiq_abort import abort
 
 
@@ -804,59 +808,121 @@ def cancel_run(request):
     return JsonResponse({"Sucess": "Run Cancelled successfully"})
 
 
+UPSTREAM_STATUS_KEY = "export_tool:upstream_status"
+UPSTREAM_STATUS_TTL = 30  # seconds, shared by all web workers
+
+
+def upstream_timestamps():
+    """
+    Last update timestamps of Overpass and the raw data API, cached in Redis
+    so frequent status polling doesn't hit either service on every request.
+    Without Redis they are fetched live.
+    """
+    r = metrics_redis()
+    try:
+        cached = r.get(UPSTREAM_STATUS_KEY)
+    except redis.RedisError as e:
+        LOG.warn("Upstream status cache unavailable: {0}".format(e))
+        r, cached = None, None
+    if cached:
+        return json.loads(cached.decode("utf-8"))
+    timestamps = {"overpass": None, "rawdata_api": None}
+    try:
+        overpass = requests.get("{}timestamp".format(settings.OVERPASS_API_URL), timeout=5)
+        timestamps["overpass"] = dateutil.parser.parse(overpass.content).isoformat()
+    except (requests.RequestException, ValueError, OverflowError) as e:
+        LOG.warn("Overpass status unavailable: {0}".format(e))
+    try:
+        galaxy = requests.get("{}v1/status/".format(settings.RAW_DATA_API_URL), timeout=5)
+        timestamps["rawdata_api"] = dateutil.parser.parse(galaxy.json()["lastUpdated"]).isoformat()
+    except (requests.RequestException, ValueError, KeyError, OverflowError) as e:
+        LOG.warn("Raw data API status unavailable: {0}".format(e))
+    if r is not None:
+        try:
+            r.setex(UPSTREAM_STATUS_KEY, UPSTREAM_STATUS_TTL, json.dumps(timestamps))
+        except redis.RedisError as e:
+            LOG.warn("Upstream status cache unavailable: {0}".format(e))
+    return timestamps
+
+
+def behind_by(timestamp):
+    if timestamp is None:
+        return "N/A"
+    return str(datetime.now(timezone.utc) - dateutil.parser.parse(timestamp))
+
+
 @require_http_methods(["GET"])
 def machine_status(request):
     if not request.user.is_superuser:
         return HttpResponseForbidden()
-    CPU_use = psutil.cpu_percent(3)
+    sample = latest_sample()
     date_from = datetime.now() - timedelta(days=1)
-    hdx_jobs = HDXExportRegion.objects.all()
-    Runs_since_day = ExportRun.objects.filter(created_at__gte=date_from)
-    running_runs = Runs_since_day.filter(status="RUNNING").order_by("-started_at")
-    if running_runs:
-        last_run_timestamp = running_runs[0].started_at
-        last_run_running_from = str(timezone.now() - last_run_timestamp)
+
+    def status_count(status):
+        return Count(Case(When(status=status, then=1)))
+
+    runs = ExportRun.objects.filter(created_at__gte=date_from).aggregate(
+        submitted=status_count("SUBMITTED"),
+        running=status_count("RUNNING"),
+        failed=status_count("FAILED"),
+        completed=status_count("COMPLETED"),
+        last_run_timestamp=Max(
+            Case(When(status="RUNNING", then=F("started_at")), output_field=DateTimeField())
+        ),
+    )
+    if runs["last_run_timestamp"]:
+        last_run_running_from = str(timezone.now() - runs["last_run_timestamp"])
     else:
-        last_run_timestamp = "N/A"
         last_run_running_from = "N/A"
-    overpass = requests.get("{}timestamp".format(settings.OVERPASS_API_URL))
-    galaxy = requests.get("{}v1/status/".format(settings.RAW_DATA_API_URL))
 
-    overpass_timestamp = str(
-        datetime.now(timezone.utc) - dateutil.parser.parse(overpass.content)
-    )
-    galaxy_timestamp = str(
-        datetime.now(timezone.utc) - dateutil.parser.parse(galaxy.json()["lastUpdated"])
+    schedules = dict(
+        HDXExportRegion.objects.values_list("schedule_period")
+        .annotate(count=Count("id"))
+        .order_by()
     )
+    upstream = upstream_timestamps()
     return JsonResponse(
         {
             "system": {
                 "current_time": datetime.now(),
-                "cpu_usage_%": int(CPU_use),
-                "ram_used_%": (psutil.virtual_memory()[2]),
-                "overpass_behind_by": overpass_timestamp,
-                "rawdata_api_behind_by": galaxy_timestamp,
+                "cpu_usage_%": int(sample["cpu_percent"]) if sample["cpu_percent"] is not None else None,
+                "ram_used_%": sample["ram_percent"],
+                "overpass_behind_by": behind_by(upstream["overpass"]),
+                "rawdata_api_behind_by": behind_by(upstream["rawdata_api"]),
             },
             "runs_since_a_day": {
-                "submitted": Runs_since_day.filter(status="SUBMITTED").count(),
-                "running": Runs_since_day.filter(status="RUNNING").count(),
+                "submitted": runs["submitted"],
+                "running": runs["running"],
                 "last_running_from": last_run_running_from,
-                "failed": Runs_since_day.filter(status="FAILED").count(),
-                "completed": Runs_since_day.filter(status="COMPLETED").count(),
+                "failed": runs["failed"],
+                "completed": runs["completed"],
             },
             "hdx": {
-                "total_jobs": hdx_jobs.count(),
-                "Running_daily": hdx_jobs.filter(schedule_period="daily").count(),
-                "Running_weekly": hdx_jobs.filter(schedule_period="weekly").count(),
-                "Running_monthly": hdx_jobs.filter(schedule_period="monthly").count(),
-                "Running_every_2_weeks": hdx_jobs.filter(
-                    schedule_period="2wks"
-                ).count(),
-                "Running_every_3_weeks": hdx_jobs.filter(
-                    schedule_period="3wks"
-                ).count(),
-                "Running_every_6hrs": hdx_jobs.filter(schedule_period="6hrs").count(),
-                "Disabled": hdx_jobs.filter(schedule_period="disabled").count(),
+                "total_jobs": sum(schedules.values()),
+                "Running_daily": schedules.get("daily", 0),
+                "Running_weekly": schedules.get("weekly", 0),
+                "Running_monthly": schedules.get("monthly", 0),
+                "Running_every_2_weeks": schedules.get("2wks", 0),
+                "Running_every_3_weeks": schedules.get("3wks", 0),
+                "Running_every_6hrs": schedules.get("6hrs", 0),
+                "Disabled": schedules.get("disabled", 0),
             },
         }
     )
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """
+    Prometheus metrics collected in the background by collect_metrics.
+    """
+    token = "Bearer {}".format(settings.METRICS_TOKEN)
+    if not request.user.is_superuser and not (
+        settings.METRICS_TOKEN
+        and hmac.compare_digest(request.META.get("HTTP_AUTHORIZATION", ""), token)
+    ):
+        return HttpResponseForbidden()
+    text = collected_metrics()
+    if text is None:
+        return HttpResponse("metrics not collected yet\n", status=503, content_type="text/plain")
+    return HttpResponse(text, content_type="text/plain; version=0.0.4")
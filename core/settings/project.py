@@ -70,9 +70,35 @@ OVERPASS_API_URL = os.getenv('OVERPASS_API_URL', 'http://overpass-api.de/api/')
 #url to galaxy api endpoint
 RAW_DATA_API_URL = os.getenv('RAW_DATA_API_URL', 'https://raw-data-api0.hotosm.org/')
 
+# max number of raw data api requests a single run keeps in flight
+GALAXY_FETCH_CONCURRENCY = int(os.getenv('GALAXY_FETCH_CONCURRENCY', 4))
+
+# fetch one geopackage per run and derive shp/kml/geojson from it with ogr2ogr,
+# instead of asking the raw data api to re-run the same extraction per format
+GALAXY_SINGLE_EXTRACT = bool(os.getenv('GALAXY_SINGLE_EXTRACT'))
+
 GENERATE_MWM = os.getenv('GENERATE_MWM','/usr/local/bin/generate_mwm.sh')
 GENERATOR_TOOL = os.getenv('GENERATOR_TOOL','/usr/local/bin/generator_tool')
 PLANET_FILE = os.getenv('PLANET_FILE','')
+# planet extracts are reused across runs when set; evicted LRU beyond the byte budget
+PLANET_EXTRACT_CACHE_DIR = os.getenv('PLANET_EXTRACT_CACHE_DIR','')
+PLANET_EXTRACT_CACHE_BYTES = int(os.getenv('PLANET_EXTRACT_CACHE_BYTES', 100 * 1024 ** 3))
+# diffs an unfiltered cached extract is rolled forward with before it is cut from the planet again
+PLANET_EXTRACT_CACHE_GENERATIONS = int(os.getenv('PLANET_EXTRACT_CACHE_GENERATIONS', 7))
+# cut every planet-backed region due in the same hour with one osmium pass (needs the cache)
+PLANET_BATCH_EXTRACT = bool(os.getenv('PLANET_BATCH_EXTRACT'))
+# planet tile shards written by build_planet_shards; runs read only the shards their region touches
+PLANET_SHARD_DIR = os.getenv('PLANET_SHARD_DIR','')
+PLANET_SHARD_ZOOM = int(os.getenv('PLANET_SHARD_ZOOM', 6))
+# run the tabular (shp/kml/gpkg) pass over sources of at least TABULAR_PARALLEL_MIN_BYTES in this many processes
+TABULAR_PROCESSES = int(os.getenv('TABULAR_PROCESSES', 1))
+TABULAR_PARALLEL_MIN_BYTES = int(os.getenv('TABULAR_PARALLEL_MIN_BYTES', 200 * 1024 ** 2))
+# collect_metrics stores Prometheus metrics here; /api/metrics also accepts this bearer token
+METRICS_REDIS_URL = os.getenv('METRICS_REDIS_URL','redis://localhost:6379/0')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# seconds between the CPU/RAM samples machine_status reports; each web worker
+# process starts its own daemon sampler thread on its first status request
+SYSTEM_SAMPLE_INTERVAL = int(os.getenv('SYSTEM_SAMPLE_INTERVAL', 3))
 WORKER_SECRET_KEY = os.getenv('WORKER_SECRET_KEY','nPsOG0vNSEpKdZMjHeQVX910aSoq6Jyp')
 
 """
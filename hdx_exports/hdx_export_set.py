@@ -2,7 +2,7 @@ import os
 from datetime import datetime
 import django.utils.text
 from hdx.data.dataset import Dataset
-from osm_export_tool.mapping import Mapping
+from utils.feature_selection import compiled_mapping
 
 FILTER_CRITERIA = """
 This theme includes all OpenStreetMap features in this area matching:
@@ -40,7 +40,7 @@ def sync_datasets(datasets,update_dataset_date=False):
 
 def sync_region(region,files=[],public_dir=''):
     export_set = HDXExportSet(
-        Mapping(region.feature_selection),
+        compiled_mapping(region.feature_selection),
         region.dataset_prefix,
         region.name,
         region.extra_notes
@@ -76,7 +76,7 @@ class HDXExportSet(object):
             columns.append('- [{0}](http://wiki.openstreetmap.org/wiki/Key:{0})'.format(key))
         columns = '\n'.join(columns)
 
-        criteria = theme.matcher.to_sql()
+        criteria = self._mapping.criteria[theme.name]
         filter_str = FILTER_CRITERIA.format(criteria=criteria)
 
         return self._extra_notes + MARKDOWN.format(
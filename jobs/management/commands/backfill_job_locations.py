@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from jobs.models import Job
+
+class Command(BaseCommand):
+    help = 'Store the centroid and country of jobs created before they were recorded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        updated = 0
+        last_id = 0
+        while True:
+            jobs = list(Job.objects.filter(country='', id__gt=last_id)
+                .order_by('id').only('id', 'the_geom')[:options['batch_size']])
+            if not jobs:
+                break
+            for job in jobs:
+                job.set_location()
+                Job.objects.filter(id=job.id).update(
+                    centroid=job.centroid, country=job.country, admin_1=job.admin_1)
+            updated += len(jobs)
+            last_id = jobs[-1].id
+        self.stdout.write('Stored locations for {0} jobs'.format(updated))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from tasks.models import ExportRun
+
+class Command(BaseCommand):
+    help = 'Store output sizes on export runs that finished before sizes were recorded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        updated = 0
+        last_id = 0
+        while True:
+            runs = list(ExportRun.objects.filter(total_size__isnull=True, id__gt=last_id)
+                .order_by('id').prefetch_related('tasks')[:options['batch_size']])
+            if not runs:
+                break
+            for run in runs:
+                run.update_sizes(run.tasks.all())
+                ExportRun.objects.filter(id=run.id).update(
+                    total_size=run.total_size, format_sizes=run.format_sizes)
+            updated += len(runs)
+            last_id = runs[-1].id
+        self.stdout.write('Stored sizes for {0} runs'.format(updated))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from tasks.extract_cache import current_planet
+from tasks.planet_shards import build_shards
+
+class Command(BaseCommand):
+    help = 'Split the planet file into tile shards so planet extracts only read the tiles they need'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--planet', help='planet file to shard, defaults to PLANET_FILE')
+        parser.add_argument('--zoom', type=int, help='shard zoom level, defaults to PLANET_SHARD_ZOOM')
+
+    def handle(self, *args, **options):
+        directory = build_shards(options['planet'] or current_planet(), options['zoom'])
+        self.stdout.write('Planet shards in {0}'.format(directory))
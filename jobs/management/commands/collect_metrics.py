@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from tasks.metrics import collect
+
+class Command(BaseCommand):
+    help = 'Collect the Prometheus metrics served at /api/metrics'
+
+    def handle(self, *args, **options):
+        text = collect()
+        self.stdout.write('Collected {0} metric lines'.format(text.count('\n')))
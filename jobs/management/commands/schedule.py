@@ -5,7 +5,7 @@ import pytz
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from jobs.models import HDXExportRegion, PartnerExportRegion
-from tasks.task_runners import ExportTaskRunner
+from tasks.task_runners import ExportTaskRunner, batch_extract_and_run
 from tasks.models import ExportRun
 from django.conf import settings
 
@@ -15,12 +15,12 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
 
         now = timezone.now()
-
+        batched = []
 
         for regioncls in [HDXExportRegion, PartnerExportRegion]:
-            for region in regioncls.objects.exclude(schedule_period='disabled'):
+            for region in regioncls.objects.exclude(schedule_period='disabled').select_related('job__latest_run'):
                 schedule_match = False
-                last_run = region.job.runs.last()
+                last_run = region.job.latest_run
                 if last_run:
                     last_run_status=last_run.status
                     if last_run_status in ['RUNNING','SUBMITTED']:
@@ -39,4 +39,10 @@ class Command(BaseCommand):
                     schedule_match = now.day == 1 and region.schedule_hour == now.hour
 
                 if schedule_match:
-                    ExportTaskRunner().run_task(job_uid=region.job.uid,ondemand=False)
\ No newline at end of file
+                    if settings.PLANET_BATCH_EXTRACT and region.planet_file:
+                        batched.append(str(region.job.uid))
+                    else:
+                        ExportTaskRunner().run_task(job_uid=region.job.uid,ondemand=False)
+
+        if batched:
+            batch_extract_and_run.send(batched)
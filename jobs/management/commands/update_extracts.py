@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from tasks.extract_cache import update_extracts
+
+class Command(BaseCommand):
+    help = 'Apply a merged replication change file to the cached planet extracts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('changes', help='merged .osc.gz change file')
+        parser.add_argument('from_sequence', help='replication sequence the extracts were cut at')
+        parser.add_argument('to_sequence', help='replication sequence after applying the changes')
+
+    def handle(self, *args, **options):
+        updated = update_extracts(options['changes'], options['from_sequence'], options['to_sequence'])
+        self.stdout.write('Updated {0} cached extracts'.format(updated))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0042_exportrunstage'),
+        ('jobs', '0078_remove_hdxexportregion_country_export'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='latest_finished_run',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tasks.ExportRun'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='latest_run',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tasks.ExportRun'),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE jobs SET
+                latest_run_id = (
+                    SELECT id FROM export_runs WHERE export_runs.job_id = jobs.id
+                    ORDER BY created_at DESC, id DESC LIMIT 1),
+                latest_finished_run_id = (
+                    SELECT id FROM export_runs WHERE export_runs.job_id = jobs.id
+                    AND started_at IS NOT NULL AND finished_at IS NOT NULL
+                    ORDER BY created_at DESC, id DESC LIMIT 1)
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0079_job_latest_runs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='admin_1',
+            field=models.CharField(blank=True, default='', editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='centroid',
+            field=django.contrib.gis.db.models.fields.PointField(blank=True, editable=False, null=True, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='country',
+            field=models.CharField(blank=True, default='', editable=False, max_length=2),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['created_at', 'country'], name='jobs_created_country_idx'),
+        ),
+        # countries need the reverse geocoding index: run backfill_job_locations
+        migrations.RunSQL(
+            "UPDATE jobs SET centroid = ST_Centroid(the_geom)",
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -16,18 +16,22 @@ from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.gis.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.db.models import Subquery
 from django.db.models.fields import CharField
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 from collections import namedtuple
 import mercantile
+import numpy
 
 from utils.aoi_utils import simplify_geom, force2d
+from utils.reverse_geocode import nearest_place
+from utils.feature_selection import compiled_mapping, validate as validate_mapping
 from django.contrib import admin
 
 import rasterio
+from rtree.core import RTreeError
 from rasterio import mask
-from osm_export_tool.mapping import Mapping
 from hdx_exports.hdx_export_set import HDXExportSet
 
 LOG = logging.getLogger(__name__)
@@ -36,6 +40,15 @@ MAX_TILE_COUNT = 10000
 DIR = os.path.dirname(os.path.abspath(__file__))
 RASTER = rasterio.open(os.path.join(DIR,'osm_nodes.tif'))
 
+def summed_area_table(dataset):
+    band = dataset.read(1).astype(numpy.int64)
+    table = numpy.zeros((band.shape[0] + 1, band.shape[1] + 1), dtype=numpy.int64)
+    table[1:, 1:] = band.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+# table[r, c] is the sum of RASTER cells above and left of (r, c)
+NODE_TABLE = summed_area_table(RASTER)
+
 Group.add_to_class('is_partner', models.BooleanField(null=False, default=False))
 
 def get_geodesic_area(geom):
@@ -65,13 +78,42 @@ def get_geodesic_area(geom):
 MAX_NODES = 10000000
 ValidateResult = namedtuple('ValidateResult',['valid','message','params'])
 
+def extent_nodes(extent):
+    """
+    Approximate nodes in the RASTER cells whose centers fall inside an EPSG:3857
+    extent (minx, miny, maxx, maxy), in constant time from NODE_TABLE.
+    """
+    minx, miny, maxx, maxy = extent
+    col0, row0 = ~RASTER.transform * (minx, maxy)
+    col1, row1 = ~RASTER.transform * (maxx, miny)
+    # cell i is counted when its center i + 0.5 is inside the extent
+    c0 = max(int(math.ceil(col0 - 0.5)), 0)
+    c1 = min(int(math.floor(col1 - 0.5)) + 1, RASTER.width)
+    r0 = max(int(math.ceil(row0 - 0.5)), 0)
+    r1 = min(int(math.floor(row1 - 0.5)) + 1, RASTER.height)
+    if c0 >= c1 or r0 >= r1:
+        return 0
+    t = NODE_TABLE
+    return int(t[r1, c1] - t[r0, c1] - t[r1, c0] + t[r0, c0]) * 1000
+
+def aoi_nodes(transformed, limit=None):
+    """
+    Approximate nodes inside an EPSG:3857 AOI. The raster is only masked
+    when the bounding box estimate is over limit (always, if limit is None).
+    """
+    # the polygon never covers more cells than its bounding box
+    nodes = extent_nodes(transformed.extent)
+    if (limit is None or nodes > limit) and not transformed.equals(transformed.envelope):
+        masked = mask.mask(RASTER,[json.loads(transformed.json)],all_touched=False)
+        nodes = int(masked[0].sum()) * 1000
+    return nodes
+
 def check_extent(aoi,url):
     if not aoi.valid:
         return ValidateResult(False,aoi.valid_reason,None)
     aoi.srid = 4326
     transformed = aoi.transform(3857,clone=True)
-    masked = mask.mask(RASTER,[json.loads(transformed.json)],all_touched=False)
-    nodes = masked[0].sum() * 1000
+    nodes = aoi_nodes(transformed, MAX_NODES)
     if nodes > MAX_NODES:
         return ValidateResult(False, "The selected area's bounding box contains about %(nodes)s nodes.\
             The maximum is %(maxnodes)s. Please choose a smaller area.",
@@ -92,8 +134,7 @@ def validate_export_formats(value):
             )
 
 def validate_feature_selection(value):
-    from osm_export_tool.mapping import Mapping
-    m, errors = Mapping.validate(value)
+    m, errors = validate_mapping(value)
     if not m:
         raise ValidationError(errors)
 
@@ -102,6 +143,20 @@ def validate_aoi(aoi):
     if not result.valid:
         raise ValidationError(result.message,params=result.params)
 
+def mbtiles_tile_count(bounds, minzoom, maxzoom):
+    tile_count = 0
+
+    for z in range(int(minzoom), int(maxzoom)):
+        sw = mercantile.tile(*bounds[0:2], zoom=z)
+        ne = mercantile.tile(*bounds[2:4], zoom=z)
+
+        width = 1 + ne[0] - sw[0]
+        height = 1 + sw[1] - ne[1]
+
+        tile_count += width * height
+
+    return tile_count
+
 def validate_mbtiles(job):
     if "mbtiles" in job["export_formats"]:
         if job.get("mbtiles_source") is None:
@@ -110,17 +165,7 @@ def validate_mbtiles(job):
         if job.get("mbtiles_maxzoom") is None or job.get("mbtiles_minzoom") is None:
             raise ValidationError("A zoom range must be provided when generating an MBTiles archive.")
 
-        bounds = job["the_geom"].extent
-        tile_count = 0
-
-        for z in range(int(job["mbtiles_minzoom"]), int(job["mbtiles_maxzoom"])):
-            sw = mercantile.tile(*bounds[0:2], zoom=z)
-            ne = mercantile.tile(*bounds[2:4], zoom=z)
-
-            width = 1 + ne[0] - sw[0]
-            height = 1 + sw[1] - ne[1]
-
-            tile_count += width * height
+        tile_count = mbtiles_tile_count(job["the_geom"].extent, job["mbtiles_minzoom"], job["mbtiles_maxzoom"])
 
         if tile_count > MAX_TILE_COUNT:
             raise ValidationError(
@@ -160,19 +205,48 @@ class Job(models.Model):
     unfiltered = models.BooleanField(default=False)
     preserve_geom = models.BooleanField(default=False)
 
+    # kept current by update_latest_runs whenever one of the job's runs is saved or deleted
+    latest_run = models.ForeignKey('tasks.ExportRun', null=True, blank=True, editable=False, related_name='+', on_delete=models.SET_NULL)
+    latest_finished_run = models.ForeignKey('tasks.ExportRun', null=True, blank=True, editable=False, related_name='+', on_delete=models.SET_NULL)
+    # where the export is, for stats; set on save
+    centroid = models.PointField(srid=4326, null=True, blank=True, editable=False)
+    country = models.CharField(max_length=2, default='', blank=True, editable=False)
+    admin_1 = models.CharField(max_length=100, default='', blank=True, editable=False)
+
     class Meta:  # pragma: no cover
         managed = True
         db_table = 'jobs'
+        indexes = [models.Index(fields=['created_at', 'country'], name='jobs_created_country_idx')]
 
     @property
     def last_run_status(self):
-        if self.runs.count() > 0:
-            return self.runs.all()[self.runs.count() - 1].status
+        if self.latest_run:
+            return self.latest_run.status
 
     @property
     def last_run_date(self):
-        if self.runs.count() > 0:
-            return self.runs.all()[self.runs.count() - 1].started_at
+        if self.latest_run:
+            return self.latest_run.started_at
+
+    def set_location(self):
+        self.centroid = self.the_geom.centroid
+        try:
+            _, self.admin_1, self.country = nearest_place(self.centroid.x, self.centroid.y)
+        except (LookupError, RTreeError) as e:
+            # left blank for backfill_job_locations
+            LOG.warn('Could not reverse geocode job {0}: {1}'.format(self.uid, e))
+
+    def update_latest_runs(self):
+        """
+        Point latest_run at the newest run and latest_finished_run
+        at the newest run that has both started and finished.
+        """
+        runs = self.runs.order_by('-created_at', '-id')
+        Job.objects.filter(id=self.id).update(
+            latest_run=Subquery(runs.values('id')[:1]),
+            latest_finished_run=Subquery(
+                runs.filter(started_at__isnull=False, finished_at__isnull=False).values('id')[:1]),
+        )
 
 
     @property
@@ -193,7 +267,10 @@ class Job(models.Model):
     def save(self, *args, **kwargs):
         self.the_geom = force2d(self.the_geom)
         self.simplified_geom = simplify_geom(self.the_geom,force_buffer=self.buffer_aoi)
+        self.set_location()
         super(Job, self).save(*args, **kwargs)
+        # this instance may hold run pointers older than the ones just overwritten
+        self.update_latest_runs()
 
     def __str__(self):
         return str(self.uid)
@@ -232,40 +309,31 @@ HOUR_CHOICES = zip(range(0, 24), range(0, 24))
 class RegionMixin:
     @property
     def last_run(self): # noqa
-        if self.job.runs.count() > 0:
-
-            last_run_time = self.job.runs.all()[self.job.runs.count() - 1].finished_at or self.job.runs.all()[self.job.runs.count() - 1].started_at or self.job.runs.all()[self.job.runs.count() - 1].created_at
-            return last_run_time
+        run = self.job.latest_run
+        if run:
+            return run.finished_at or run.started_at or run.created_at
 
     @property
     def last_run_status(self):
-        if self.job.runs.count() > 0:
-            return self.job.runs.all()[self.job.runs.count() - 1].status
+        if self.job.latest_run:
+            return self.job.latest_run.status
 
     @property
     def last_run_duration(self):
-        if self.job.runs.count() > 0:
-            i=1
-            last_run_duration = None
-            while (last_run_duration is None):  # get previous run size if current is running/submitted
-                if i >= self.job.runs.count() and i != 1: 
-                    break
-                last_run_duration = self.job.runs.all()[self.job.runs.count() - i].duration
-                i+=1
-            return time.strftime('%H:%M:%S', time.gmtime(last_run_duration))
+        # previous run's duration if the current one is running/submitted
+        run = self.job.latest_finished_run
+        if run:
+            return time.strftime('%H:%M:%S', time.gmtime(run.duration))
 
 
     @property
     def last_size(self):
-        if self.job.runs.count() > 0:
-            i=1
-            last_run_size = 0
-            while (last_run_size == 0):  # get previous run size if current is running/submitted
-                if i >= self.job.runs.count() and i != 1: 
-                    break
-                last_run_size = self.job.runs.all()[self.job.runs.count() - i].size
-                i+=1
-            return last_run_size
+        if self.job.latest_run:
+            # get previous run size if current is running/submitted
+            for run in (self.job.latest_run, self.job.latest_finished_run):
+                if run and run.size:
+                    return run.size
+            return 0
 
     @property
     def last_export_size(self):
@@ -273,8 +341,8 @@ class RegionMixin:
             return size(self.last_size)
     @property
     def last_run_hdx_sync(self):
-        if self.job.runs.count() > 0:
-            return self.job.runs.all()[self.job.runs.count() - 1].hdx_sync_status
+        if self.job.latest_run:
+            return self.job.latest_run.hdx_sync_status
 
     @property
     def next_run_hum(self):
@@ -496,7 +564,7 @@ class HDXExportRegion(models.Model, RegionMixin): # noqa
     @property
     def datasets(self): # noqa
         export_set = HDXExportSet(
-            Mapping(self.feature_selection),
+            compiled_mapping(self.feature_selection),
             self.dataset_prefix,
             self.name,
             self.extra_notes
@@ -1,22 +1,52 @@
 import argparse
+import fcntl
 import glob
+import gzip
 import shutil
 import json
 import os
 import logging
 import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
 from osmium.replication import server
 from datetime import datetime,timezone
 
 # 0 3 * * * /home/exports/venv/bin/python /home/exports/osm-export-tool/jobs/secondary_pipeline.py /mnt/data/planet/ >> /home/exports/secondary_pipeline.log 2>&1
+# or, following the minutely feed in batches (each batch still rewrites the whole planet):
+# */10 * * * * /home/exports/venv/bin/python /home/exports/osm-export-tool/jobs/secondary_pipeline.py /mnt/data/planet/ --replication minute --max-diffs 60 >> /home/exports/secondary_pipeline.log 2>&1
 
 parser = argparse.ArgumentParser(description='osmium-tool based pipeline')
 parser.add_argument('directory', help='Working directory - needs a lot of space')
+parser.add_argument('--update-extracts', action='store_true', help='Also apply the changes to the cached region extracts')
+parser.add_argument('--build-shards', action='store_true', help='Split the updated planet into tile shards')
+parser.add_argument('--replication', choices=['day','hour','minute'], default='day', help='Replication feed to follow. Every run rewrites the whole planet with apply-changes (a full planet read and write), whatever the feed, so hour and minute only pay off with runs spaced to match that cost')
+parser.add_argument('--max-diffs', type=int, help='Apply at most this many diffs per run')
+parser.add_argument('--keep', type=int, default=2, help='Planet versions to keep for exports still reading them')
+parser.add_argument('--retain-hours', type=float, default=12, help='Keep replaced planet versions at least this long; the longest export time limit')
 parsed = parser.parse_args()
 workdir = parsed.directory
+
+# planet.osm.pbf is a symlink to the newest planet-<sequence>.osm.pbf.
+# Workers resolve it when a run starts, so a new version can be published
+# while running exports keep reading the one they started with.
 planet = os.path.join(workdir,'planet.osm.pbf')
 
 PLANET_OSM_PBF = 'https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf'
+REPLICATION_URL = 'https://planet.openstreetmap.org/replication/{0}'
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_ATTEMPTS = 3
+MERGE_CHUNK = 30
+
+lock = open(os.path.join(workdir,'secondary_pipeline.lock'),'w')
+try:
+	fcntl.flock(lock,fcntl.LOCK_EX | fcntl.LOCK_NB)
+except BlockingIOError:
+	logging.warning('Another update is still running')
+	exit(0)
 
 if not os.path.isfile(planet):
 	logging.warning('Downloading planet.osm.pbf')
@@ -24,38 +54,140 @@ if not os.path.isfile(planet):
 
 fileinfo = json.loads(subprocess.check_output(['osmium','fileinfo','-j',planet]))
 option = fileinfo['header']['option']
-daily = server.ReplicationServer('https://planet.openstreetmap.org/replication/day')
+replication_url = REPLICATION_URL.format(parsed.replication)
+replication = server.ReplicationServer(replication_url)
 
-if 'osmosis_replication_sequence_number' in option:
+# sequence numbers are only meaningful within one feed
+if 'osmosis_replication_sequence_number' in option and option.get('osmosis_replication_base_url',REPLICATION_URL.format('day')) == replication_url:
 	seqnum = int(option['osmosis_replication_sequence_number'])
 else:
 	timestamp = fileinfo['header']['option']['osmosis_replication_timestamp']
 	timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
 	timestamp = timestamp.replace(tzinfo=timezone.utc)
 	logging.warning("Timestamp is {0}".format(timestamp))
-	seqnum = daily.timestamp_to_sequence(timestamp)
+	seqnum = replication.timestamp_to_sequence(timestamp)
 
 logging.warning("Seqnum is {0}".format(seqnum))
-latest = daily.get_state_info().sequence
+latest = replication.get_state_info().sequence
+if parsed.max_diffs:
+	latest = min(latest,seqnum+parsed.max_diffs)
 logging.warning("Latest is {0}".format(latest))
-if seqnum == latest:
+if seqnum >= latest:
 	exit(0)
+latest_timestamp = replication.get_state_info(latest).timestamp
 
-try:
-	os.mkdir(os.path.join(workdir,'tmp'))
-except:
-	pass
+tmp = os.path.join(workdir,'tmp',parsed.replication)
+os.makedirs(tmp,exist_ok=True)
 
-try:
-	for i in range(seqnum+1,latest+1):
-		subprocess.call(['wget','-O',os.path.join(workdir,'tmp','{0}.osc.gz'.format(i)),daily.get_diff_url(i)])
-
-	g = glob.glob(os.path.join(workdir,'tmp','*.osc.gz'))
-	subprocess.call(['osmium','merge-changes','--overwrite','--simplify',*g,'-o',os.path.join(workdir,'merged-changes.osc.gz')])
-	subprocess.call(['osmium','apply-changes','--output-header','osmosis_replication_sequence_number={0}'.format(latest),planet,os.path.join(workdir,'merged-changes.osc.gz'),'-o',os.path.join(workdir,'planet-updated.osm.pbf')])
-	os.rename(os.path.join(workdir,'planet-updated.osm.pbf'),planet)
-except:
-	pass
-finally:
-	shutil.rmtree(os.path.join(workdir,'tmp'))
+# diffs and chunk merges are kept in tmp until the planet is replaced,
+# so an interrupted catch-up picks up where it stopped
+def diff_path(i):
+	return os.path.join(tmp,'{0}.osc.gz'.format(i))
+
+def chunk_path(first,last):
+	return os.path.join(tmp,'merged-{0}-{1}.osc.gz'.format(first,last))
+
+def verified(path):
+	try:
+		with gzip.open(path,'rb') as f:
+			while f.read(1024*1024):
+				pass
+		return True
+	except (OSError,EOFError,zlib.error):
+		return False
+
+def download(i):
+	path = diff_path(i)
+	if os.path.isfile(path):
+		return i
+	partial = path + '.part'
+	for attempt in range(DOWNLOAD_ATTEMPTS):
+		try:
+			with requests.get(replication.get_diff_url(i),stream=True,timeout=60*5) as r:
+				r.raise_for_status()
+				with open(partial,'wb') as f:
+					for chunk in r.iter_content(chunk_size=1024*1024):
+						f.write(chunk)
+		except requests.RequestException as e:
+			logging.warning("Downloading {0} failed: {1}".format(i,e))
+			continue
+		if verified(partial):
+			os.rename(partial,path)
+			return i
+		logging.warning("Diff {0} is corrupt, retrying".format(i))
+	raise ValueError("Could not download diff {0}".format(i))
+
+def merge(paths,output):
+	partial = output + '.part'
+	subprocess.check_call(['osmium','merge-changes','--overwrite','--simplify',*paths,'-f','osc.gz','-o',partial])
+	os.rename(partial,output)
+
+# leftovers from an earlier catch-up that already made it into the planet
+for name in os.listdir(tmp):
+	seq = name.split('.')[0].split('-')[-1]
+	if not seq.isdigit() or int(seq) <= seqnum or name.endswith('.part'):
+		os.remove(os.path.join(tmp,name))
+
+# merge contiguous runs of MERGE_CHUNK diffs while later ones are still downloading
+chunks = [(first,min(first+MERGE_CHUNK-1,latest)) for first in range(seqnum+1,latest+1,MERGE_CHUNK)]
+downloaded = set(i for i in range(seqnum+1,latest+1) if os.path.isfile(diff_path(i)))
+pending = [c for c in chunks if not os.path.isfile(chunk_path(*c))]
+logging.warning("Resuming with {0} diffs downloaded and {1} of {2} chunks merged".format(len(downloaded),len(chunks)-len(pending),len(chunks)))
+
+def merge_ready():
+	while pending and all(i in downloaded for i in range(pending[0][0],pending[0][1]+1)):
+		first,last = pending.pop(0)
+		merge([diff_path(i) for i in range(first,last+1)],chunk_path(first,last))
+		# the last chunk grows as new diffs are published, keep its inputs
+		if last - first + 1 == MERGE_CHUNK:
+			for i in range(first,last+1):
+				os.remove(diff_path(i))
+
+needed = [i for (first,last) in pending for i in range(first,last+1) if i not in downloaded]
+with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+	futures = [executor.submit(download,i) for i in needed]
+	for future in as_completed(futures):
+		downloaded.add(future.result())
+		merge_ready()
+# nothing left to download when resuming after an interrupted merge
+merge_ready()
+assert not pending, "Chunks {0} were not merged".format(pending)
+
+merged = os.path.join(workdir,'merged-changes.osc.gz')
+merge([chunk_path(*c) for c in chunks],merged)
+version = os.path.join(workdir,'planet-{0}.osm.pbf'.format(latest))
+subprocess.check_call(['osmium','apply-changes','--overwrite',
+	'--output-header','osmosis_replication_sequence_number={0}'.format(latest),
+	'--output-header','osmosis_replication_timestamp={0}'.format(latest_timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")),
+	'--output-header','osmosis_replication_base_url={0}'.format(replication_url),
+	planet,merged,'-f','pbf','-o',version])
+
+# swap the symlink atomically; new runs pick up the new version
+link = planet + '.tmp'
+if os.path.lexists(link):
+	os.remove(link)
+if not os.path.islink(planet):
+	# first update: keep the downloaded planet as a version, runs may be reading it
+	previous = os.path.join(workdir,'planet-{0}.osm.pbf'.format(seqnum))
+	if not os.path.exists(previous):
+		logging.warning("Moving {0} to {1}".format(planet,previous))
+		os.link(planet,previous)
+os.symlink(os.path.basename(version),link)
+os.replace(link,planet)
+shutil.rmtree(tmp)
+
+# a version can be read until the longest running export that resolved it
+# finishes: keep it until retain_hours after the version that replaced it
+current = os.path.realpath(planet)
+retired_before = time.time() - parsed.retain_hours * 60 * 60
+versions = sorted(glob.glob(os.path.join(workdir,'planet-*.osm.pbf')),key=os.path.getmtime)
+for old,replaced_by in list(zip(versions,versions[1:]))[:max(len(versions)-parsed.keep,0)]:
+	if os.path.realpath(old) != current and os.path.getmtime(replaced_by) < retired_before:
+		logging.warning("Removing old planet version {0}".format(old))
+		os.remove(old)
 
+manage = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','manage.py')
+if parsed.update_extracts:
+	subprocess.call([sys.executable,manage,'update_extracts',merged,str(seqnum),str(latest)])
+if parsed.build_shards:
+	subprocess.call([sys.executable,manage,'build_planet_shards','--planet',version])
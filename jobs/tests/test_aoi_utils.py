@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from django.test import SimpleTestCase
+
+from utils.aoi_utils import MAX_COORDS, MAX_TOLERANCE, SEARCH_PASSES, simplify_geom, simplify_to
+
+
+class CountingGeom(object):
+    # gets under any budget from the tolerance fits_from up
+    def __init__(self, calls, fits_from, num_coords=10 ** 6):
+        self.calls = calls
+        self.fits_from = fits_from
+        self.num_coords = num_coords
+
+    def simplify(self, tolerance, preserve_topology=False):
+        self.calls.append(tolerance)
+        return CountingGeom(self.calls, self.fits_from, 10 if tolerance >= self.fits_from else 10 ** 6)
+
+
+def simplify_doubling(geom):
+    # the loop simplify_to replaced
+    tolerance = 0.01
+    while geom.num_coords > MAX_COORDS:
+        geom = geom.simplify(tolerance, preserve_topology=True)
+        tolerance = tolerance * 2
+    return geom
+
+
+class TestSimplifyGeom(SimpleTestCase):
+
+    def test_small_aoi_unchanged(self):
+        aoi = Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752))
+        self.assertTrue(simplify_geom(aoi).equals_exact(aoi))
+
+    def test_vertex_budget_and_containment(self):
+        aoi = Point(10, 10).buffer(1, quadsegs=1000)
+        self.assertGreater(aoi.num_coords, MAX_COORDS)
+        simplified = simplify_geom(aoi)
+        self.assertLessEqual(simplified.num_coords, MAX_COORDS)
+        self.assertTrue(simplified.contains(aoi))
+
+    def test_tighter_than_doubling(self):
+        buffered = Point(10, 10).buffer(1, quadsegs=1000).buffer(0.02)
+        simplified = simplify_to(buffered)
+        doubled = simplify_doubling(buffered)
+        # uses most of the budget where doubling overshoots to a handful of vertices
+        self.assertLessEqual(simplified.num_coords, MAX_COORDS)
+        self.assertGreater(simplified.num_coords, MAX_COORDS / 2)
+        self.assertLess(doubled.num_coords, simplified.num_coords)
+        self.assertLess(simplified.sym_difference(buffered).area, doubled.sym_difference(buffered).area)
+
+    def test_many_polygons(self):
+        # more rings than the budget allows at any tolerance
+        squares = [Polygon.from_bbox((i, 0, i + 0.5, 0.5)) for i in range(200)]
+        self.assertGreater(simplify_geom(MultiPolygon(squares)).num_coords, MAX_COORDS)
+
+    def test_bounded_passes(self):
+        calls = []
+        simplify_to(CountingGeom(calls, fits_from=0.001))
+        self.assertEqual(len(calls), SEARCH_PASSES + 1)
+        # settles within a few percent of the smallest tolerance that fits
+        fitting = [tolerance for tolerance in calls if tolerance >= 0.001]
+        self.assertLess(min(fitting), 0.001 * 1.05)
+
+    def test_unreachable_budget(self):
+        calls = []
+        simplify_to(CountingGeom(calls, fits_from=float('inf')))
+        self.assertEqual(calls, [MAX_TOLERANCE])
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.test import SimpleTestCase
+
+from jobs.management.commands.update_hdx_yaml import NEW_YAML
+from utils.feature_selection import compiled_mapping, validate
+
+
+class TestCompiledMapping(SimpleTestCase):
+
+    def test_is_not_null(self):
+        # the HDX default selects features with IS NOT NULL, which osmium tags-filter can't express
+        mapping = compiled_mapping(NEW_YAML)
+        self.assertEqual(set(mapping.criteria), set(theme.name for theme in mapping.themes))
+        self.assertIn('IS NOT NULL', mapping.criteria['Buildings'])
+        self.assertIs(compiled_mapping(NEW_YAML), mapping)
+        self.assertEqual(validate(NEW_YAML), (mapping, None))
+
+    def test_invalid(self):
+        mapping, errors = validate("buildings:\n  types:\n    - polygons\n")
+        self.assertIsNone(mapping)
+        self.assertEqual(len(errors), 1)
+
+    def test_empty_select(self):
+        feature_selection = "buildings:\n  types:\n    - polygons\n  select: []\n"
+        mapping, errors = validate(feature_selection)
+        self.assertIsNone(errors)
+        self.assertEqual(mapping.criteria, {'buildings': ''})
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 from unittest import skip
 
+from mock import patch
+
 from django.contrib.auth.models import User
-from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.contrib.gis.geos import Polygon
 from django.core.exceptions import ValidationError
 from django.test import TestCase
 
-from jobs.models import Job, HDXExportRegion
+from jobs.models import Job, HDXExportRegion, RASTER, check_extent, extent_nodes
+from rasterio import mask
 from feature_selection.feature_selection import FeatureSelection
 
 LOG = logging.getLogger(__name__)
@@ -77,6 +81,21 @@ class TestJob(TestCase):
             job.full_clean()
         self.assertTrue('feature_selection' in e.exception.message_dict)
         self.assertEqual(e.exception.message_dict['feature_selection'],[u'YAML must be dict, not list'])
+
+    @patch('jobs.models.nearest_place', side_effect=LookupError('No reverse geocoding index'))
+    def test_save_without_reverse_geocoding(self, nearest_place):
+        job = Job(**self.fixture)
+        job.save()
+        self.assertIsNotNone(job.id)
+        self.assertIsNotNone(job.centroid)
+        self.assertEqual(job.country, '')
+
+    @patch('utils.reverse_geocode._idx', None)
+    @patch('utils.reverse_geocode.INDEX_PATH', '/nonexistent/reverse_geocode')
+    def test_missing_reverse_geocoding_index(self):
+        from utils.reverse_geocode import nearest_place
+        with self.assertRaises(LookupError):
+            nearest_place(0, 0)
         
 
 class TestHDXExportRegion(TestCase):
@@ -113,3 +132,15 @@ class TestHDXExportRegion(TestCase):
         with self.assertRaises(ValidationError) as e:
             region.full_clean()
         self.assertTrue('dataset_prefix' in e.exception.message_dict)
+
+class TestCheckExtent(TestCase):
+    def test_extent_nodes_matches_raster_mask(self):
+        aoi = Polygon.from_bbox((5.0, 45.0, 15.0, 55.0))
+        aoi.srid = 4326
+        transformed = aoi.transform(3857, clone=True)
+        masked = mask.mask(RASTER, [json.loads(transformed.json)], all_touched=False)
+        self.assertEqual(extent_nodes(transformed.extent), masked[0].sum() * 1000)
+
+    def test_large_extent_is_invalid(self):
+        self.assertFalse(check_extent(Polygon.from_bbox((-10.0, 35.0, 30.0, 60.0)), None).valid)
+        self.assertTrue(check_extent(Polygon.from_bbox((-10.80029, 6.3254236, -10.79809, 6.32752)), None).valid)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Cut the extracts for many planet-backed regions with one osmium pass.
+
+Every planet-backed run would otherwise read the whole planet on its own.
+The scheduler hands the regions due in the same hour to extract_regions,
+which builds one `osmium extract` config with a polygon per region and
+stores each result in the planet extract cache under the key the run
+itself will look up.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import join
+
+import shapely.geometry
+from django.conf import settings
+from osm_export_tool.sources import OsmiumTool
+
+from jobs.models import HDXExportRegion
+from utils.aoi_utils import to_shapely
+from utils.feature_selection import compiled_mapping
+from .extract_cache import current_planet, extract_key, extract_meta, get_cache, planet_sequence
+
+LOG = logging.getLogger(__name__)
+
+GALAXY_FORMATS = {'geojson', 'geopackage', 'kml', 'shp', 'fgb', 'csv', 'sql'}
+HDX_GALAXY_FORMATS = {'geojson', 'shp', 'kml', 'geopackage', 'csv'}
+
+# osmium keeps one output buffer per extract, so split very large batches
+MAX_EXTRACTS_PER_PASS = 100
+
+
+def uses_planet_extract(region):
+    """Whether a run for this region reads an osmium extract of the planet (see run_task)."""
+    if not region.planet_file:
+        return False
+    formats = set(region.job.export_formats)
+    if isinstance(region, HDXExportRegion):
+        if formats.issubset(HDX_GALAXY_FORMATS):
+            return False
+        return not (settings.USE_RAW_DATA_API_FOR_HDX and formats.issubset(GALAXY_FORMATS))
+    if region.polygon_centroid and region.group.name == 'PDC':
+        # PDC runs filter the whole planet themselves
+        return False
+    return not formats.issubset(GALAXY_FORMATS)
+
+
+def region_extract(region):
+    """(geometry, feature selection used as a tags filter) exactly as run_task builds them."""
+    job = region.job
+    geom = to_shapely(job.simplified_geom)
+    if isinstance(region, HDXExportRegion):
+        return geom, None
+    return geom, job.feature_selection
+
+
+def tags_filters(feature_selection):
+    """osmium tags-filter expressions for a feature selection, or None where OsmiumTool can't express it."""
+    try:
+        return sorted(OsmiumTool.filters(compiled_mapping(feature_selection)))
+    except ValueError as e:
+        # e.g. IS NOT NULL and comparison clauses
+        LOG.warn('Cannot filter a planet extract: {0}'.format(e))
+        return None
+
+
+def extract_regions(regions):
+    """
+    Pre-cut planet extracts for regions into the extract cache.
+    Regions whose extract is already cached are skipped, and so are those
+    whose feature selection osmium tags-filter can't express: an unfiltered
+    extract under their key would differ from what the run itself cuts.
+    """
+    cache = get_cache()
+    if cache is None:
+        LOG.warn('Batch planet extraction needs PLANET_EXTRACT_CACHE_DIR, skipping.')
+        return
+
+    planet = current_planet()
+    sequence = planet_sequence(planet)
+    pending = {}
+    for region in regions:
+        if not uses_planet_extract(region):
+            continue
+        geom, feature_selection = region_extract(region)
+        key = extract_key(geom, feature_selection, sequence)
+        if key in pending or os.path.isfile(cache.path(key)):
+            continue
+        filters = tags_filters(feature_selection) if feature_selection else None
+        if feature_selection and filters is None:
+            continue
+        pending[key] = (geom, feature_selection, filters)
+
+    keys = list(pending.keys())
+    for i in range(0, len(keys), MAX_EXTRACTS_PER_PASS):
+        batch = keys[i:i + MAX_EXTRACTS_PER_PASS]
+        tempdir = tempfile.mkdtemp(dir=settings.EXPORT_STAGING_ROOT)
+        try:
+            extracts = []
+            for key in batch:
+                geom, _, _ = pending[key]
+                polygon_path = join(tempdir, key + '.geojson')
+                with open(polygon_path, 'w') as f:
+                    f.write(json.dumps({'type': 'Feature', 'geometry': shapely.geometry.mapping(geom)}))
+                extracts.append({
+                    'output': key + '.osm.pbf',
+                    'polygon': {'file_name': polygon_path, 'file_type': 'geojson'},
+                })
+            config_path = join(tempdir, 'extracts.json')
+            with open(config_path, 'w') as f:
+                f.write(json.dumps({'directory': tempdir, 'extracts': extracts}))
+
+            LOG.debug('Batch extracting {0} regions from {1}'.format(len(batch), planet))
+            subprocess.check_call(
+                ['osmium', 'extract', '-c', config_path, planet, '--overwrite'])
+
+            for key in batch:
+                path = join(tempdir, key + '.osm.pbf')
+                geom, feature_selection, filters = pending[key]
+                if filters:
+                    filtered = join(tempdir, key + '.filtered.osm.pbf')
+                    subprocess.check_call(
+                        ['osmium', 'tags-filter', path, *filters, '-o', filtered, '--overwrite'])
+                    path = filtered
+                cache.put(key, path, extract_meta(geom, feature_selection, sequence))
+        finally:
+            shutil.rmtree(tempdir, True)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Grid-indexed clipping for tabular.Handler.
+
+The Handler decides whether a feature needs clipping with a prepared AOI,
+which GEOS already answers from an index in about a microsecond. Features
+crossing the AOI boundary are then intersected with the whole AOI, which
+overlays every one of its edges. GridClip splits the AOI's bounds into a
+grid and intersects those features with only the part of the AOI inside
+the cells their bounding box covers, computed once per group of cells.
+"""
+import math
+
+from cachetools import LRUCache
+from shapely.geometry import box
+
+from .theme_index import IndexedHandler
+
+# cells per side
+GRID_SIZE = 32
+
+# AOI pieces kept for reuse, keyed by the cells they cover
+MAX_PIECES = 4096
+
+
+class GridClip(object):
+    """Stands in for the AOI where tabular.Handler intersects features with it."""
+
+    def __init__(self, geom, size=GRID_SIZE):
+        self.geom = geom
+        self.minx, self.miny, maxx, maxy = geom.bounds
+        self.size = size
+        # a degenerate AOI still gets a usable grid
+        self.dx = (maxx - self.minx) / size or 1.0
+        self.dy = (maxy - self.miny) / size or 1.0
+        self.pieces = LRUCache(maxsize=MAX_PIECES)
+
+    def __bool__(self):
+        return True
+
+    def cells(self, bounds):
+        """(i0, j0, i1, j1) of the grid cells covering bounds; the AOI has nothing beyond the grid."""
+        minx, miny, maxx, maxy = bounds
+        last = self.size - 1
+        return (
+            min(max(int(math.floor((minx - self.minx) / self.dx)), 0), last),
+            min(max(int(math.floor((miny - self.miny) / self.dy)), 0), last),
+            min(max(int(math.floor((maxx - self.minx) / self.dx)), 0), last),
+            min(max(int(math.floor((maxy - self.miny) / self.dy)), 0), last),
+        )
+
+    def piece(self, cells):
+        """The AOI within a block of cells, plus a margin against rounding."""
+        if cells not in self.pieces:
+            i0, j0, i1, j1 = cells
+            mx, my = self.dx / 4, self.dy / 4
+            self.pieces[cells] = self.geom.intersection(box(
+                self.minx + i0 * self.dx - mx, self.miny + j0 * self.dy - my,
+                self.minx + (i1 + 1) * self.dx + mx, self.miny + (j1 + 1) * self.dy + my))
+        return self.pieces[cells]
+
+    def intersection(self, geom):
+        return self.piece(self.cells(geom.bounds)).intersection(geom)
+
+
+class ClippingHandler(IndexedHandler):
+    """IndexedHandler that clips boundary features against a GridClip of the AOI."""
+
+    def __init__(self, outputs, mapping, clipping_geom=None, polygon_centroid=False):
+        super(ClippingHandler, self).__init__(outputs, mapping, clipping_geom=clipping_geom, polygon_centroid=polygon_centroid)
+        if clipping_geom:
+            self.clipping_geom = GridClip(clipping_geom)
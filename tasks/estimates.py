@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Estimate what an export will cost before it is submitted.
+
+Node counts come from the osm_nodes.tif raster (see jobs.models). Output size
+and duration per format come from straight-line fits of recent successful
+ExportTasks against the bounding box node count of their job's AOI.
+"""
+import numpy
+from cachetools.func import ttl_cache
+
+from jobs.models import MAX_NODES, MAX_TILE_COUNT, aoi_nodes, extent_nodes, mbtiles_tile_count
+from .models import ExportTask
+
+# recent successful tasks per format to fit against
+HISTORY = 500
+
+# fewer samples than this and a format gets no estimate
+MIN_SAMPLES = 5
+
+# seconds; runs expected to take longer than the ondemand actor's time limit
+ONDEMAND_TIME_LIMIT = 60 * 60 * 4
+
+
+def fit(nodes, values):
+    """(intercept, slope) of values against nodes."""
+    if len(set(nodes)) < 2:
+        return float(numpy.mean(values)), 0.0
+    slope, intercept = numpy.polyfit(nodes, values, 1)
+    return float(intercept), float(slope)
+
+
+def predict(model, nodes):
+    intercept, slope = model
+    return max(0, int(round(intercept + slope * nodes)))
+
+
+@ttl_cache(ttl=60 * 60)
+def format_models():
+    """{format: {'size': (intercept, slope), 'duration': (intercept, slope)}}"""
+    models = {}
+    # no ordering, or Meta.ordering's created_at makes every task distinct
+    names = ExportTask.objects.filter(status='SUCCESS').order_by().values_list('name', flat=True).distinct()
+    for name in names:
+        tasks = ExportTask.objects.filter(
+            name=name, status='SUCCESS', started_at__isnull=False,
+            finished_at__isnull=False, filesize_bytes__isnull=False
+        ).order_by('-finished_at').values_list(
+            'run__job_id', 'run__job__simplified_geom', 'filesize_bytes', 'started_at', 'finished_at'
+        )[:HISTORY]
+
+        job_nodes = {}
+        nodes, sizes, durations = [], [], []
+        for job_id, geom, filesize_bytes, started_at, finished_at in tasks:
+            if geom is None:
+                continue
+            if job_id not in job_nodes:
+                job_nodes[job_id] = extent_nodes(geom.transform(3857, clone=True).extent)
+            nodes.append(job_nodes[job_id])
+            sizes.append(filesize_bytes)
+            durations.append((finished_at - started_at).total_seconds())
+
+        if len(nodes) >= MIN_SAMPLES:
+            models[name] = {'size': fit(nodes, sizes), 'duration': fit(nodes, durations)}
+    return models
+
+
+def estimate_export(geom, export_formats, mbtiles_minzoom=None, mbtiles_maxzoom=None):
+    """
+    Estimated cost of exporting a 4326 GEOSGeometry to export_formats.
+    Sizes and durations are None for formats without enough history; the
+    total duration adds up the formats, so it errs on the long side.
+    """
+    transformed = geom.transform(3857, clone=True)
+    nodes = aoi_nodes(transformed)
+    # the fits are against bounding box counts, so predict from one too
+    bbox_nodes = extent_nodes(transformed.extent)
+
+    tile_count = None
+    if 'mbtiles' in export_formats and mbtiles_minzoom is not None and mbtiles_maxzoom is not None:
+        tile_count = mbtiles_tile_count(geom.extent, mbtiles_minzoom, mbtiles_maxzoom)
+
+    models = format_models()
+    formats = {}
+    for name in export_formats:
+        model = models.get(name)
+        formats[name] = {
+            'size_bytes': predict(model['size'], bbox_nodes) if model else None,
+            'duration_seconds': predict(model['duration'], bbox_nodes) if model else None,
+        }
+
+    known = [f for f in formats.values() if f['size_bytes'] is not None]
+    size_bytes = sum(f['size_bytes'] for f in known) if known else None
+    duration_seconds = sum(f['duration_seconds'] for f in known) if known else None
+
+    queue = None
+    if duration_seconds is not None:
+        queue = 'default' if duration_seconds < ONDEMAND_TIME_LIMIT else 'scheduled'
+
+    return {
+        'nodes': nodes,
+        'max_nodes': MAX_NODES,
+        'tile_count': tile_count,
+        'max_tile_count': MAX_TILE_COUNT,
+        'formats': formats,
+        'size_bytes': size_bytes,
+        'duration_seconds': duration_seconds,
+        'queue': queue,
+    }
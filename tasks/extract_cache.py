@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of planet extracts.
+
+Scheduled HDX/Partner regions re-run the same osmium extract against the
+planet file over and over. Extracts are keyed by the simplified geometry,
+the mapping filter and the planet replication sequence number, so a
+repeated run against an unchanged planet skips the planet scan entirely.
+Entries are evicted least-recently-used first once the cache exceeds its
+disk budget.
+
+Each entry keeps a JSON sidecar with the geometry, filter and sequence it
+was cut with, so update_extracts can roll unfiltered entries forward with
+the daily replication diff instead of cutting them from the planet again.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+from os.path import exists, join
+
+import shapely.geometry
+import shapely.wkb
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+
+_sequences = {}
+
+
+def current_planet():
+    """
+    The planet version PLANET_FILE currently points at.
+    secondary_pipeline.py publishes versions behind a symlink; a run resolves it
+    once so it keeps reading the same version while a newer one is published.
+    """
+    return os.path.realpath(settings.PLANET_FILE)
+
+
+def planet_sequence(planet_path):
+    """
+    Replication sequence number of a planet file, read from its header.
+    Falls back to the file's mtime and size when the header has no sequence.
+    """
+    stat = os.stat(planet_path)
+    memo_key = (planet_path, stat.st_mtime, stat.st_size)
+    if memo_key not in _sequences:
+        fileinfo = json.loads(subprocess.check_output(['osmium', 'fileinfo', '-j', planet_path]))
+        option = fileinfo['header']['option']
+        if 'osmosis_replication_sequence_number' in option:
+            _sequences[memo_key] = option['osmosis_replication_sequence_number']
+        else:
+            _sequences[memo_key] = '{0}-{1}'.format(int(stat.st_mtime), stat.st_size)
+    return _sequences[memo_key]
+
+
+def extract_key(geom, feature_selection=None, sequence=None):
+    """
+    Cache key for an extract of a shapely geometry,
+    optionally filtered by a feature selection, at a planet sequence.
+    """
+    h = hashlib.sha256()
+    h.update(geom.wkb)
+    h.update(b'\0')
+    h.update((feature_selection or '').encode('utf-8'))
+    h.update(b'\0')
+    h.update(str(sequence).encode('utf-8'))
+    return h.hexdigest()
+
+
+def extract_meta(geom, feature_selection=None, sequence=None, generation=0):
+    # generation: diffs applied since the extract was cut from the planet
+    return {
+        'geometry': geom.wkb_hex,
+        'feature_selection': feature_selection,
+        'sequence': str(sequence),
+        'generation': generation,
+    }
+
+
+# mode of cache entries and of the files linked from them
+ENTRY_MODE = 0o644
+
+
+def _link_or_copy(src, dst):
+    # extracts can be tens of GB: hard link when the cache shares the filesystem
+    tmp = '{0}.{1}.tmp'.format(dst, uuid.uuid4().hex)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ExtractCache(object):
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        if not exists(root):
+            os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return join(self.root, key + '.osm.pbf')
+
+    def meta_path(self, key):
+        return join(self.root, key + '.json')
+
+    def meta(self, key):
+        try:
+            with open(self.meta_path(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get(self, key, output_path):
+        """Place a cached extract at output_path. Returns True on a hit."""
+        cached = self.path(key)
+        try:
+            _link_or_copy(cached, output_path)
+        except FileNotFoundError:
+            return False
+        # mtime is the LRU clock
+        os.utime(cached)
+        return True
+
+    def put(self, key, source_path, meta=None):
+        if meta is not None:
+            with open(self.meta_path(key), 'w') as f:
+                json.dump(meta, f)
+        _link_or_copy(source_path, self.path(key))
+        # hits are hard links, and the osm_pbf output is chmod'ed to this
+        # once it's moved to downloads: set it here so that is a no-op
+        os.chmod(self.path(key), ENTRY_MODE)
+        self.evict()
+
+    def remove(self, key):
+        for path in (self.path(key), self.meta_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.osm.pbf'):
+                continue
+            try:
+                stat = os.stat(join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            LOG.debug('Evicting cached extract {0}'.format(name))
+            self.remove(name[:-len('.osm.pbf')])
+            total -= size
+
+
+def get_cache():
+    if not settings.PLANET_EXTRACT_CACHE_DIR:
+        return None
+    return ExtractCache(settings.PLANET_EXTRACT_CACHE_DIR, settings.PLANET_EXTRACT_CACHE_BYTES)
+
+
+def _extract(source):
+    # read only the planet shards the region touches when there are any
+    from .planet_shards import shard_path
+    source.source_path = shard_path(source.source_path, source.geom, source.tempdir)
+    return source.path()
+
+
+def cached_extract_path(source, output_path, geom, feature_selection=None):
+    """
+    source.path() for an OsmiumTool planet extract, but reuse a cached
+    extract when there is one and store freshly built extracts for the next run.
+    """
+    cache = get_cache()
+    if cache is None:
+        return _extract(source)
+    sequence = planet_sequence(source.source_path)
+    key = extract_key(geom, feature_selection, sequence)
+    if cache.get(key, output_path):
+        LOG.debug('Using cached planet extract {0}'.format(key))
+        return output_path
+    path = _extract(source)
+    cache.put(key, path, extract_meta(geom, feature_selection, sequence))
+    return path
+
+
+def update_extracts(changes_path, from_sequence, to_sequence, max_generations=None):
+    """
+    Roll every unfiltered cached extract cut at from_sequence forward to
+    to_sequence by applying the merged replication diff and clipping it
+    back to the region.
+
+    The change file is global; clipping drops everything outside the region
+    again. A way that moves into the region while reusing untouched nodes
+    misses those nodes, so an entry is dropped after max_generations diffs
+    (PLANET_EXTRACT_CACHE_GENERATIONS) and cut from the planet again.
+    Filtered entries are dropped straight away: an object that starts
+    matching the filter would be missing its unchanged nodes.
+    """
+    cache = get_cache()
+    if cache is None:
+        return 0
+    if max_generations is None:
+        max_generations = settings.PLANET_EXTRACT_CACHE_GENERATIONS
+    from_sequence, to_sequence = str(from_sequence), str(to_sequence)
+
+    updated = 0
+    for _, _, name in cache.entries():
+        key = name[:-len('.osm.pbf')]
+        meta = cache.meta(key)
+        if not meta or meta['sequence'] != from_sequence:
+            continue
+        generation = meta.get('generation', 0)
+        if meta['feature_selection'] or generation >= max_generations:
+            cache.remove(key)
+            continue
+        geom = shapely.wkb.loads(bytes.fromhex(meta['geometry']))
+        tempdir = tempfile.mkdtemp(dir=cache.root)
+        try:
+            applied = join(tempdir, 'applied.osm.pbf')
+            subprocess.check_call(
+                ['osmium', 'apply-changes', cache.path(key), changes_path, '-o', applied, '--overwrite'])
+            region_json = join(tempdir, 'region.json')
+            with open(region_json, 'w') as f:
+                f.write(json.dumps({'type': 'Feature', 'geometry': shapely.geometry.mapping(geom)}))
+            clipped = join(tempdir, 'clipped.osm.pbf')
+            subprocess.check_call(
+                ['osmium', 'extract', '-p', region_json, applied, '-o', clipped, '--overwrite'])
+            cache.put(
+                extract_key(geom, None, to_sequence), clipped,
+                extract_meta(geom, None, to_sequence, generation + 1))
+            cache.remove(key)
+            updated += 1
+        except subprocess.CalledProcessError:
+            LOG.warn('Could not update cached extract {0}, dropping it'.format(key))
+            cache.remove(key)
+        finally:
+            shutil.rmtree(tempdir, True)
+    return updated
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Re-encode a single raw data API (Galaxy) extract into several output formats.
+
+The raw data API runs its spatial query once per requested output format.
+When a run asks for several formats of the same area and feature selection,
+the export pipeline can fetch one geopackage and derive the other formats
+from it locally with ogr2ogr.
+"""
+import logging
+import os
+import sqlite3
+import subprocess
+import zipfile
+from glob import glob
+from os.path import basename, join
+
+import requests
+
+import osm_export_tool
+
+LOG = logging.getLogger(__name__)
+
+# export format name -> (ogr driver, file extension, layer creation options)
+# csv is left to the raw data API: its csv carries each feature's centroid,
+# which a plain ogr2ogr conversion of the geopackage wouldn't match
+OGR_FORMATS = {
+    'shp': ('ESRI Shapefile', 'shp', []),
+    'kml': ('KML', 'kml', []),
+    'geojson': ('GeoJSON', 'geojson', []),
+}
+
+# formats that can share one extract: the geopackage itself plus everything ogr2ogr derives
+SINGLE_EXTRACT_FORMATS = ['geopackage'] + list(OGR_FORMATS.keys())
+
+
+def download_extract(response_back, stage_dir):
+    """
+    Download and unpack the geopackage zips returned by Galaxy.fetch('gpkg').
+
+    Returns a list of (response entry, [geopackage paths]) pairs.
+    """
+    extracts = []
+    for i, r in enumerate(response_back):
+        target_dir = join(stage_dir, 'galaxy_extract_{0}'.format(i))
+        os.makedirs(target_dir)
+        zip_path = join(target_dir, 'extract.zip')
+        with requests.get(r['download_url'], stream=True, timeout=60 * 5) as resp:
+            resp.raise_for_status()
+            with open(zip_path, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+        with zipfile.ZipFile(zip_path) as z:
+            z.extractall(target_dir)
+        os.remove(zip_path)
+        gpkgs = glob(join(target_dir, '**', '*.gpkg'), recursive=True)
+        if not gpkgs:
+            raise ValueError('No geopackage found in {0}'.format(r['download_url']))
+        extracts.append((r, gpkgs))
+    return extracts
+
+
+def feature_layers(gpkg_path):
+    with sqlite3.connect(gpkg_path) as conn:
+        rows = conn.execute(
+            "SELECT table_name FROM gpkg_contents WHERE data_type = 'features'").fetchall()
+    return [row[0] for row in rows]
+
+
+def output_file_name(r, output_name):
+    # raw data api names files <prefix>_gpkg; swap in the derived format
+    name = r.get('file_name') or basename(r['download_url'])
+    if name.endswith('.zip'):
+        name = name[:-len('.zip')]
+    if name.lower().endswith('_gpkg'):
+        name = name[:-len('_gpkg')]
+    return '{0}_{1}'.format(name, output_name)
+
+
+def convert_extract(extracts, output_name, stage_dir, download_dir, add_metadata=None):
+    """
+    Convert every layer of the downloaded extracts to output_name
+    and package one zip per response entry (one per theme for HDX runs).
+
+    Returns a list of osm_export_tool.File, ready for finish_task.
+    """
+    driver, ext, options = OGR_FORMATS[output_name]
+    files = []
+    for r, gpkgs in extracts:
+        name = output_file_name(r, output_name)
+        out_dir = join(stage_dir, name)
+        os.makedirs(out_dir)
+        for gpkg in gpkgs:
+            for layer in feature_layers(gpkg):
+                dest = join(out_dir, '{0}.{1}'.format(layer, ext))
+                subprocess.check_call(
+                    ['ogr2ogr', '-f', driver, *options, dest, gpkg, layer])
+
+        destination = join(download_dir, name + '.zip')
+        with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED, True) as z:
+            if add_metadata and 'theme' in r:
+                add_metadata(z, r['theme'])
+            for part in sorted(os.listdir(out_dir)):
+                z.write(join(out_dir, part), part)
+        extra = {'theme': r['theme']} if 'theme' in r else {}
+        files.append(osm_export_tool.File(output_name, [destination], extra))
+    return files
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Pick the osmium node location index for a handler pass over an extract.
+
+Sparse indexes store an id and a location per node, dense ones a location
+for every id up to the largest, so dense only pays off when most ids are
+present. Extracts whose sparse index fits comfortably in available memory
+use flex_mem, osmium's in-memory default. Larger ones get a file-backed,
+mmap'd index in the stage directory, dense if the node ids are dense enough.
+"""
+import json
+import subprocess
+from os.path import getsize, join
+
+import psutil
+
+SPARSE_BYTES = 16
+DENSE_BYTES = 8
+
+# PBF bytes per node in typical extracts, on the low side so node counts are overestimated
+PBF_BYTES_PER_NODE = 8
+
+# share of available memory one index may use
+MEMORY_SHARE = 0.5
+
+
+def node_stats(path):
+    """(node count, largest node id) of an OSM file; reads the whole file."""
+    info = json.loads(subprocess.check_output(['osmium', 'fileinfo', '-e', '-j', path]))
+    return info['data']['count']['nodes'], info['data']['maxid']['nodes']
+
+
+def choose_index(path, directory, processes=1):
+    """idx argument for apply_file on path; processes share the memory budget."""
+    budget = psutil.virtual_memory().available * MEMORY_SHARE / processes
+    if getsize(path) / PBF_BYTES_PER_NODE * SPARSE_BYTES <= budget:
+        return 'flex_mem'
+    # counting is a full read, only worth it once the index may not fit
+    nodes, max_id = node_stats(path)
+    if nodes * SPARSE_BYTES <= budget:
+        return 'flex_mem'
+    if max_id * DENSE_BYTES <= nodes * SPARSE_BYTES:
+        return 'dense_file_array,' + join(directory, 'locations.idx')
+    return 'sparse_file_array,' + join(directory, 'locations.idx')
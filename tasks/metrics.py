@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus text-format metrics, computed in the background.
+
+collect_metrics (run every minute by export_metrics.timer) folds the runs,
+tasks and stages that finished since the previous collection into
+cumulative histograms and counters kept in Redis, samples queue depths and
+machine load, and stores the rendered exposition text. The /api/metrics
+endpoint only reads that text back, so a scrape costs one Redis GET.
+"""
+import json
+import shutil
+import time
+from datetime import timedelta
+
+import psutil
+import redis
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from jobs.models import HDXExportRegion, PartnerExportRegion
+from .models import ExportRun, ExportRunStage, ExportTask
+
+METRICS_KEY = 'export_tool:metrics'
+STATE_KEY = 'export_tool:metrics_state'
+
+QUEUES = ('default', 'scheduled')
+
+# seconds, from a quick Galaxy fetch up to the 12 hour scheduled time limit
+BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 43200)
+
+# rows committed shortly after the collection started are picked up next time
+LAG = timedelta(minutes=1)
+
+HELP = {
+    'export_run_duration_seconds': ('histogram', 'Wall time of finished export runs by data source.'),
+    'export_task_duration_seconds': ('histogram', 'Wall time of successful export tasks by format.'),
+    'export_stage_duration_seconds': ('histogram', 'Wall time of export run stages; galaxy:* and source are upstream latency.'),
+    'export_runs_total': ('counter', 'Finished export runs by status.'),
+    'export_output_bytes_total': ('counter', 'Bytes produced by successful export tasks by format.'),
+    'export_runs_in_progress': ('gauge', 'Export runs submitted or running.'),
+    'dramatiq_queue_messages': ('gauge', 'Messages in each Dramatiq queue by state.'),
+    'export_worker_processes': ('gauge', 'Dramatiq worker processes on this machine.'),
+    'export_worker_rss_bytes': ('gauge', 'Resident memory of all Dramatiq worker processes.'),
+    'machine_cpu_percent': ('gauge', 'CPU use of this machine over one second.'),
+    'machine_ram_percent': ('gauge', 'Memory use of this machine.'),
+    'export_disk_used_ratio': ('gauge', 'Used fraction of the export download volume.'),
+    'export_metrics_collected_timestamp_seconds': ('gauge', 'When these metrics were collected.'),
+}
+
+
+def redis_client():
+    return redis.Redis.from_url(settings.METRICS_REDIS_URL)
+
+
+def label_key(labels):
+    return json.dumps(labels, sort_keys=True)
+
+
+def observe(state, name, labels, value):
+    series = state['histograms'].setdefault(name, {}).setdefault(label_key(labels), {
+        'labels': labels, 'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0})
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            series['buckets'][i] += 1
+    series['sum'] += value
+    series['count'] += 1
+
+
+def inc(state, name, labels, value=1):
+    series = state['counters'].setdefault(name, {}).setdefault(label_key(labels), {
+        'labels': labels, 'value': 0})
+    series['value'] += value
+
+
+def new_state():
+    # start counting from now rather than replaying every stage ever recorded
+    stage_id = ExportRunStage.objects.aggregate(Max('id'))['id__max'] or 0
+    return {'finished_until': None, 'stage_id': stage_id, 'histograms': {}, 'counters': {}}
+
+
+def run_sources(runs):
+    """Data source per run id: planet, overpass or raw_data_api."""
+    job_ids = set(run.job_id for run in runs)
+    planet_jobs = set(HDXExportRegion.objects.filter(job_id__in=job_ids, planet_file=True).values_list('job_id', flat=True))
+    planet_jobs |= set(PartnerExportRegion.objects.filter(job_id__in=job_ids, planet_file=True).values_list('job_id', flat=True))
+    source_runs = set(ExportRunStage.objects.filter(run__in=runs, name='source').values_list('run_id', flat=True))
+    sources = {}
+    for run in runs:
+        if run.job_id in planet_jobs:
+            sources[run.id] = 'planet'
+        elif run.id in source_runs:
+            sources[run.id] = 'overpass'
+        else:
+            sources[run.id] = 'raw_data_api'
+    return sources
+
+
+def fold_finished(state, until):
+    """Add everything that finished since the last collection to the cumulative series."""
+    since = parse_datetime(state['finished_until']) if state['finished_until'] else until - LAG
+
+    runs = list(ExportRun.objects.filter(finished_at__gt=since, finished_at__lte=until)
+        .only('id', 'job_id', 'status', 'started_at', 'finished_at'))
+    sources = run_sources(runs)
+    for run in runs:
+        inc(state, 'export_runs_total', {'status': run.status})
+        if run.started_at:
+            observe(state, 'export_run_duration_seconds', {'source': sources[run.id]},
+                (run.finished_at - run.started_at).total_seconds())
+
+    tasks = ExportTask.objects.filter(finished_at__gt=since, finished_at__lte=until, status='SUCCESS') \
+        .values_list('name', 'started_at', 'finished_at', 'filesize_bytes')
+    for name, started_at, finished_at, filesize_bytes in tasks:
+        if started_at:
+            observe(state, 'export_task_duration_seconds', {'format': name},
+                (finished_at - started_at).total_seconds())
+        inc(state, 'export_output_bytes_total', {'format': name}, filesize_bytes or 0)
+
+    # stages are written once, when they end
+    stages = list(ExportRunStage.objects.filter(id__gt=state['stage_id'], duration__isnull=False)
+        .select_related('run').order_by('id'))
+    stage_sources = run_sources(list({stage.run_id: stage.run for stage in stages}.values()))
+    for stage in stages:
+        observe(state, 'export_stage_duration_seconds',
+            {'stage': stage.name, 'source': stage_sources[stage.run_id]}, stage.duration)
+        state['stage_id'] = stage.id
+
+    state['finished_until'] = until.isoformat()
+
+
+def queue_depths(r):
+    depths = []
+    for queue in QUEUES:
+        depths.append(({'queue': queue, 'state': 'ready'}, r.llen('dramatiq:{0}'.format(queue))))
+        depths.append(({'queue': queue, 'state': 'delayed'}, r.llen('dramatiq:{0}.DQ'.format(queue))))
+        depths.append(({'queue': queue, 'state': 'dead'}, r.zcard('dramatiq:{0}.XQ'.format(queue))))
+    return depths
+
+
+def worker_processes():
+    processes = []
+    for p in psutil.process_iter(['cmdline', 'memory_info']):
+        cmdline = p.info['cmdline'] or []
+        if any('dramatiq' in part for part in cmdline[:2]) and p.info['memory_info']:
+            processes.append(p.info['memory_info'].rss)
+    return processes
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+def render(state, gauges):
+    lines = []
+
+    def header(name):
+        kind, text = HELP[name]
+        lines.append('# HELP {0} {1}'.format(name, text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    for name, series in sorted(state['histograms'].items()):
+        header(name)
+        for s in series.values():
+            for bound, count in zip(BUCKETS, s['buckets']):
+                lines.append('{0}_bucket{1} {2}'.format(name, format_labels(s['labels'], le=bound), count))
+            lines.append('{0}_bucket{1} {2}'.format(name, format_labels(s['labels'], le='+Inf'), s['count']))
+            lines.append('{0}_sum{1} {2}'.format(name, format_labels(s['labels']), s['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, format_labels(s['labels']), s['count']))
+    for name, series in sorted(state['counters'].items()):
+        header(name)
+        for s in series.values():
+            lines.append('{0}{1} {2}'.format(name, format_labels(s['labels']), s['value']))
+    for name, samples in gauges:
+        header(name)
+        for labels, value in samples:
+            lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def collect():
+    """Update the cumulative series and store freshly rendered metrics. Returns the text."""
+    r = redis_client()
+    now = timezone.now()
+    raw = r.get(STATE_KEY)
+    state = json.loads(raw.decode('utf-8')) if raw else new_state()
+    fold_finished(state, now - LAG)
+    r.set(STATE_KEY, json.dumps(state))
+
+    in_progress = ExportRun.objects.filter(status__in=['SUBMITTED', 'RUNNING']) \
+        .values('status').annotate(count=Count('id')).order_by()
+    workers = worker_processes()
+    disk = shutil.disk_usage(settings.EXPORT_DOWNLOAD_ROOT)
+    gauges = [
+        ('export_runs_in_progress', [({'status': row['status']}, row['count']) for row in in_progress]),
+        ('dramatiq_queue_messages', queue_depths(r)),
+        ('export_worker_processes', [({}, len(workers))]),
+        ('export_worker_rss_bytes', [({}, sum(workers))]),
+        ('machine_cpu_percent', [({}, psutil.cpu_percent(1))]),
+        ('machine_ram_percent', [({}, psutil.virtual_memory().percent)]),
+        ('export_disk_used_ratio', [({}, disk.used / disk.total)]),
+        ('export_metrics_collected_timestamp_seconds', [({}, int(time.time()))]),
+    ]
+    text = render(state, gauges)
+    r.set(METRICS_KEY, text)
+    return text
+
+
+def latest():
+    """The most recently collected metrics text, or None."""
+    text = redis_client().get(METRICS_KEY)
+    return text.decode('utf-8') if text else None
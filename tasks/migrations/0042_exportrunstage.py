@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0041_exportrun_hdx_sync_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportRunStage',
+            fields=[
+                ('id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(db_index=True, max_length=50)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('duration', models.FloatField(null=True)),
+                ('bytes_in', models.BigIntegerField(null=True)),
+                ('bytes_out', models.BigIntegerField(null=True)),
+                ('peak_rss', models.BigIntegerField(null=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='tasks.ExportRun')),
+            ],
+            options={
+                'db_table': 'export_run_stages',
+                'ordering': ['started_at'],
+            },
+        ),
+    ]
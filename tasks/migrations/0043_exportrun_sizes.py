@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:25
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0042_exportrunstage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportrun',
+            name='format_sizes',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='exportrun',
+            name='total_size',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 16:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0044_dailystats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportrunstage',
+            name='detail',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
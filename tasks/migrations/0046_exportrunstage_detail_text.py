@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 19:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0045_exportrunstage_detail'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportrunstage',
+            name='detail',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -8,8 +8,10 @@ from hurry.filesize import size
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from jobs.models import Job, HDXExportRegion, SavedFeatureSelection, PartnerExportRegion
 from django.contrib import admin
 from django.contrib.gis.admin import GeoModelAdmin
@@ -76,6 +78,9 @@ class ExportRun(models.Model):
     )
     started_at = models.DateTimeField(null=True, editable=False)
     finished_at = models.DateTimeField(editable=False, null=True)
+    # output sizes in bytes, set as each task finishes (see backfill_run_sizes for older runs)
+    total_size = models.BigIntegerField(null=True, editable=False)
+    format_sizes = JSONField(default=dict, editable=False)
 
     class Meta:
         db_table = 'export_runs'
@@ -119,9 +124,22 @@ class ExportRun(models.Model):
 
     @property
     def size(self):
+        if self.total_size is not None:
+            return self.total_size
         return sum(map(
             lambda task: task.filesize_bytes or 0, self.tasks.all()))
 
+    def update_sizes(self, tasks=None):
+        """Set the output size of each format and their total."""
+        tasks = self.tasks.all() if tasks is None else tasks
+        self.format_sizes = {task.name: task.filesize_bytes or 0 for task in tasks}
+        self.total_size = sum(self.format_sizes.values())
+
+    def save_sizes(self):
+        """update_sizes and save just those fields, e.g. after a task finishes."""
+        self.update_sizes()
+        self.save(update_fields=['total_size', 'format_sizes'])
+
     @property
     def run_size(self):
         if self.size:
@@ -216,6 +234,86 @@ class ExportTask(models.Model):
 
 
 
+@receiver(post_save, sender=ExportRun)
+@receiver(post_delete, sender=ExportRun)
+def update_job_latest_runs(sender, instance, **kwargs):
+    Job(id=instance.job_id).update_latest_runs()
+
+
+class ExportRunStage(models.Model):
+    """
+    Wall time, bytes and peak memory of one stage of an export run,
+    e.g. the source download, apply_file, a Galaxy fetch or packaging one format.
+    """
+    id = models.AutoField(primary_key=True, editable=False)
+    run = models.ForeignKey(ExportRun, related_name='stages')
+    name = models.CharField(max_length=50, db_index=True)
+    started_at = models.DateTimeField(default=timezone.now, editable=False)
+    duration = models.FloatField(null=True) # seconds
+    bytes_in = models.BigIntegerField(null=True)
+    bytes_out = models.BigIntegerField(null=True)
+    peak_rss = models.BigIntegerField(null=True) # bytes, worker process only
+    failed = models.BooleanField(default=False)
+    detail = models.TextField(blank=True, default='') # e.g. the location index apply_file used, per tile when parallel
+
+    class Meta:
+        db_table = 'export_run_stages'
+        ordering = ['started_at']
+
+    def __str__(self):
+        return '{0} {1}'.format(self.run_id, self.name)
+
+
+class DailyStats(models.Model):
+    """
+    Jobs, users and runs of one past UTC day, as read by the stats and
+    run_stats endpoints. Built on demand by tasks.rollups and marked stale
+    when something counted in it changes.
+    """
+    day = models.DateField(unique=True)
+    stats = JSONField(default=dict)
+    stale = models.BooleanField(default=False)
+
+    class Meta:
+        db_table = 'daily_stats'
+
+    def __str__(self):
+        return str(self.day)
+
+    @classmethod
+    def invalidate(cls, *times):
+        days = set(t.date() for t in times if t)
+        if days:
+            cls.objects.filter(day__in=days).update(stale=True)
+
+
+@receiver(post_save, sender=ExportRun)
+@receiver(post_delete, sender=ExportRun)
+def invalidate_run_day(sender, instance, **kwargs):
+    DailyStats.invalidate(instance.started_at)
+
+@receiver(post_save, sender=Job)
+@receiver(post_delete, sender=Job)
+def invalidate_job_day(sender, instance, **kwargs):
+    DailyStats.invalidate(instance.created_at)
+
+# users are saved on every login, only joining and leaving change the counts
+@receiver(post_save, sender=User)
+def invalidate_joined_day(sender, instance, created, **kwargs):
+    if created:
+        DailyStats.invalidate(instance.date_joined)
+
+@receiver(post_delete, sender=User)
+def invalidate_user_day(sender, instance, **kwargs):
+    DailyStats.invalidate(instance.date_joined)
+
+# runs count as hdx_run when their job has a region
+@receiver(post_save, sender=HDXExportRegion)
+@receiver(post_delete, sender=HDXExportRegion)
+def invalidate_region_run_days(sender, instance, **kwargs):
+    DailyStats.invalidate(*ExportRun.objects.filter(job_id=instance.job_id).values_list('started_at', flat=True))
+
+
 class ExportRunAdmin(admin.ModelAdmin,ExportCsvMixin):
 
     def start(self, request, queryset):
@@ -243,6 +341,14 @@ class ExportRunAdmin(admin.ModelAdmin,ExportCsvMixin):
                         reverse('admin:jobs_job_change',
                         args=(obj.job.id,)))
 
+class ExportRunStageAdmin(admin.ModelAdmin):
+    list_display = ['run','name','started_at','duration','bytes_in','bytes_out','peak_rss','failed','detail']
+    search_fields = ['run__uid']
+    list_filter = ('name','failed')
+    raw_id_fields = ('run',)
+    date_hierarchy = 'started_at'
+    ordering = ('-started_at',)
+
 class ExportTaskAdmin(admin.ModelAdmin):
     list_display = ['uid','run','name','status','created_at','username','task_size','task_duration']
     search_fields = ['uid','run__uid']
@@ -271,6 +377,7 @@ class JobAdmin(GeoModelAdmin,ExportCsvMixin):
 
     search_fields = ['uid', 'name', 'user__username']
     list_display = ['uid', 'name','description', 'user','is_hdx','export_formats','last_run_date','last_run_status','created_at', 'updated_at','area']
+    list_select_related = ('user','latest_run')
     list_filter = ('pinned',)
     exclude = ['the_geom']
     raw_id_fields = ("user",)
@@ -289,6 +396,7 @@ class HDXExportRegionAdmin(admin.ModelAdmin, ExportCsvMixin):
     date_hierarchy = 'job__updated_at'
     ordering = ('job__updated_at',)
     actions = ["export_as_csv"]
+    list_select_related = ('job__user','job__latest_run','job__latest_finished_run')
 
     def job_link(self, obj):
         return mark_safe(f"""<a href="https://{settings.HOSTNAME}/en/v3/exports/{obj.job.uid}" target="_blank">UI Job Link</a>""")
@@ -312,4 +420,5 @@ admin.site.register(HDXExportRegion, HDXExportRegionAdmin)
 admin.site.register(PartnerExportRegion, PartnerExportRegionAdmin)
 admin.site.register(ExportRun, ExportRunAdmin)
 admin.site.register(ExportTask, ExportTaskAdmin)
+admin.site.register(ExportRunStage, ExportRunStageAdmin)
 admin.site.register(SavedFeatureSelection, SavedFeatureSelectionAdmin)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Run the tabular (shp, kml, gpkg) pass over a large source in several processes.
+
+The source is cut into a grid of tiles with one `osmium extract -s smart`
+pass, so every way and multipolygon touching a tile is complete in that
+tile's file. Each process runs a handler over one tile into outputs of its
+own, but only for the objects the tile owns: nodes by their location, ways
+and areas by their first node. Objects crossing tile edges are in several
+files yet written exactly once. The tiles' outputs are then appended to
+the run's outputs.
+"""
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import subprocess
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
+
+import osgeo.ogr as ogr
+import shapely.wkb
+from django.conf import settings
+
+import osm_export_tool.tabular as tabular
+
+from utils.feature_selection import compiled_mapping
+
+from .clipping import ClippingHandler
+from .location_index import choose_index
+
+LOG = logging.getLogger(__name__)
+
+# more tiles than processes evens out tiles with very different amounts of data
+TILES_PER_PROCESS = 4
+
+# degrees; tile extracts overlap so rounding to osmium's fixed precision can't drop an owned node
+MARGIN = 1e-5
+
+
+class TileGrid(object):
+    """cols x rows tiles over bounds; the outer tiles reach to the edges of the world."""
+
+    def __init__(self, bounds, cols, rows):
+        self.minx, self.miny, maxx, maxy = bounds
+        self.cols, self.rows = cols, rows
+        self.dx = (maxx - self.minx) / cols or 1.0
+        self.dy = (maxy - self.miny) / rows or 1.0
+
+    @classmethod
+    def covering(cls, bounds, tiles):
+        side = int(math.ceil(math.sqrt(tiles)))
+        return cls(bounds, side, side)
+
+    def __len__(self):
+        return self.cols * self.rows
+
+    def owner(self, lon, lat):
+        i = min(max(int(math.floor((lon - self.minx) / self.dx)), 0), self.cols - 1)
+        j = min(max(int(math.floor((lat - self.miny) / self.dy)), 0), self.rows - 1)
+        return j * self.cols + i
+
+    def bbox(self, tile):
+        j, i = divmod(tile, self.cols)
+        return [
+            -180.0 if i == 0 else self.minx + i * self.dx - MARGIN,
+            -90.0 if j == 0 else self.miny + j * self.dy - MARGIN,
+            180.0 if i == self.cols - 1 else self.minx + (i + 1) * self.dx + MARGIN,
+            90.0 if j == self.rows - 1 else self.miny + (j + 1) * self.dy + MARGIN,
+        ]
+
+
+class OwnedHandler(ClippingHandler):
+    """Handler that only writes the objects its tile of a TileGrid owns."""
+
+    def __init__(self, outputs, mapping, grid, tile, clipping_geom=None, polygon_centroid=False):
+        super(OwnedHandler, self).__init__(outputs, mapping, clipping_geom=clipping_geom, polygon_centroid=polygon_centroid)
+        self.grid = grid
+        self.tile = tile
+
+    def owns(self, location):
+        # objects with missing nodes fail the same way in every tile, report them once
+        if not location.valid():
+            return self.tile == 0
+        return self.grid.owner(location.lon, location.lat) == self.tile
+
+    def node(self, n):
+        if len(n.tags) and self.owns(n.location):
+            super(OwnedHandler, self).node(n)
+
+    def way(self, w):
+        if len(w.tags) and len(w.nodes) and self.owns(w.nodes[0].location):
+            super(OwnedHandler, self).way(w)
+
+    def area(self, a):
+        if not len(a.tags):
+            return
+        for ring in a.outer_rings():
+            if self.owns(ring[0].location):
+                super(OwnedHandler, self).area(a)
+            return
+
+
+def index_name(idx):
+    # without the index file's path
+    return idx.split(',')[0]
+
+
+def split(source, grid, directory):
+    """One extract per tile of grid, cut in a single osmium pass."""
+    extracts = [{'output': '{0}.osm.pbf'.format(tile), 'bbox': grid.bbox(tile)} for tile in range(len(grid))]
+    config_path = join(directory, 'extracts.json')
+    with open(config_path, 'w') as f:
+        f.write(json.dumps({'directory': directory, 'extracts': extracts}))
+    subprocess.check_call(['osmium', 'extract', '-s', 'smart', '-c', config_path, source, '--overwrite'])
+    return [join(directory, e['output']) for e in extracts]
+
+
+def output_layers(output):
+    """(path, layer name, key) of each layer an output writes to."""
+    layers = []
+    for key, layer in output.layers.items():
+        ds = getattr(layer, 'ds', None) or output.ds
+        layers.append((ds.GetDescription(), layer.ogr_layer.GetName(), key))
+    return layers
+
+
+def process_tile(args):
+    tile, path, directory, output_classes, feature_selection, clip_wkb, polygon_centroid, grid, processes = args
+    os.makedirs(directory, exist_ok=True)
+    mapping = compiled_mapping(feature_selection)
+    outputs = [getattr(tabular, name)(join(directory, 'part'), mapping) for name in output_classes]
+    clipping_geom = shapely.wkb.loads(clip_wkb) if clip_wkb else None
+    h = OwnedHandler(outputs, mapping, grid, tile, clipping_geom=clipping_geom, polygon_centroid=polygon_centroid)
+    idx = choose_index(path, directory, processes)
+    h.apply_file(path, locations=True, idx=idx)
+    layers = [output_layers(output) for output in outputs]
+    for output in outputs:
+        output.finalize()
+    return layers, index_name(idx)
+
+
+def append(output, layers):
+    """Copy the features of a tile's layers into the matching layers of output."""
+    copied = set()
+    for path, name, key in layers:
+        if (path, name) in copied:
+            continue
+        copied.add((path, name))
+        target = output.layers[key]
+        ds = ogr.Open(path)
+        for feature in ds.GetLayerByName(name):
+            out = ogr.Feature(target.defn)
+            out.SetFrom(feature)
+            target.ogr_layer.CreateFeature(out)
+        ds = None
+
+
+def apply_file(handler, source_path, geom, feature_selection, stage_dir, processes=None):
+    """
+    handler.apply_file(source_path), split over processes when the source is
+    at least TABULAR_PARALLEL_MIN_BYTES. geom is the shapely AOI the source covers.
+    Returns the location index used, e.g. 'flex_mem' or '16 tiles: flex_mem x16'.
+    """
+    processes = processes or settings.TABULAR_PROCESSES
+    if processes < 2 or not handler.outputs or os.path.getsize(source_path) < settings.TABULAR_PARALLEL_MIN_BYTES:
+        idx = choose_index(source_path, stage_dir)
+        LOG.debug('Reading {0} with the {1} location index'.format(source_path, idx))
+        handler.apply_file(source_path, locations=True, idx=idx)
+        return index_name(idx)
+
+    directory = join(stage_dir, 'tiles')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        grid = TileGrid.covering(geom.bounds, processes * TILES_PER_PROCESS)
+        LOG.debug('Splitting {0} into {1} tiles'.format(source_path, len(grid)))
+        paths = split(source_path, grid, directory)
+
+        clipping_geom = getattr(handler.clipping_geom, 'geom', handler.clipping_geom)
+        clip_wkb = clipping_geom.wkb if clipping_geom is not None else None
+        output_classes = [type(output).__name__ for output in handler.outputs]
+        jobs = [
+            (tile, path, join(directory, str(tile)), output_classes, feature_selection,
+             clip_wkb, handler.polygon_centroid, grid, processes)
+            for tile, path in enumerate(paths)
+        ]
+        indexes = Counter()
+        # spawn: the run's process has threads and open connections that shouldn't be forked
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for layers, idx in pool.map(process_tile, jobs):
+                indexes[idx] += 1
+                for output, tile_layers in zip(handler.outputs, layers):
+                    append(output, tile_layers)
+    finally:
+        shutil.rmtree(directory, True)
+    return '{0} tiles: {1}'.format(len(grid), ', '.join(
+        '{0} x{1}'.format(idx, count) for idx, count in indexes.most_common()))
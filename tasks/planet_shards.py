@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Split the planet into coarse web mercator tile shards.
+
+An osmium extract reads the whole planet even for a city-sized region.
+build_shards writes the planet out as one file per tile (zoom 6 by default)
+together with an index.json, in a directory named after the planet's
+replication sequence. shard_path then hands a run only the shards its
+region intersects, so extract time scales with the size of the region.
+
+Shards are cut with osmium's smart strategy: every way and multipolygon
+touching a tile is complete in that tile's shard, so extracting a region
+from the merged shards gives the same result as extracting it from the planet.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import basename, isfile, join
+
+import mercantile
+from django.conf import settings
+from shapely.geometry import box
+from shapely.prepared import prep
+
+from .extract_cache import planet_sequence
+
+LOG = logging.getLogger(__name__)
+
+# zoom levels descended per osmium pass: 64 outputs per pass
+SPLIT_ZOOMS = 3
+
+# shard sets to keep, so runs still on the previous planet version can use theirs
+KEEP_SHARD_SETS = 2
+
+
+def tile_key(tile):
+    return '{0}/{1}/{2}'.format(tile.z, tile.x, tile.y)
+
+
+def tile_bbox(tile):
+    """Tile bounds, with the top and bottom rows stretched to the poles."""
+    west, south, east, north = mercantile.bounds(*tile)
+    if tile.y == 0:
+        north = 90.0
+    if tile.y == 2 ** tile.z - 1:
+        south = -90.0
+    return west, south, east, north
+
+
+def descendants(tile, zoom):
+    tiles = [tile]
+    while tiles[0].z < zoom:
+        tiles = [child for t in tiles for child in mercantile.children(*t)]
+    return tiles
+
+
+def shard_tiles(geom, zoom):
+    """Tiles at zoom whose bounds intersect a shapely geometry."""
+    west, south, east, north = geom.bounds
+    prepared = prep(geom)
+    return [
+        t for t in mercantile.tiles(west, south, east, north, [zoom], truncate=True)
+        if prepared.intersects(box(*tile_bbox(t)))
+    ]
+
+
+def split(source, tiles, directory):
+    """Cut source into one file per tile in a single osmium pass."""
+    extracts = [{
+        'output': tile_key(t).replace('/', '-') + '.osm.pbf',
+        'bbox': list(tile_bbox(t)),
+    } for t in tiles]
+    config_path = join(directory, 'extracts.json')
+    with open(config_path, 'w') as f:
+        f.write(json.dumps({'directory': directory, 'extracts': extracts}))
+    subprocess.check_call(
+        ['osmium', 'extract', '-s', 'smart', '-c', config_path, source, '--overwrite'])
+    os.remove(config_path)
+    return [(t, join(directory, e['output'])) for t, e in zip(tiles, extracts)]
+
+
+def shard_dir(sequence):
+    return join(settings.PLANET_SHARD_DIR, str(sequence))
+
+
+def build_shards(planet, zoom=None):
+    """
+    Shard a planet file at zoom, descending SPLIT_ZOOMS levels per pass.
+    Returns the shard directory; an existing shard set for the planet is reused.
+    """
+    zoom = zoom or settings.PLANET_SHARD_ZOOM
+    sequence = planet_sequence(planet)
+    target = shard_dir(sequence)
+    if isfile(join(target, 'index.json')):
+        return target
+
+    os.makedirs(settings.PLANET_SHARD_DIR, exist_ok=True)
+    work = tempfile.mkdtemp(dir=settings.PLANET_SHARD_DIR)
+    try:
+        level = [(mercantile.Tile(0, 0, 0), planet)]
+        while level[0][0].z < zoom:
+            step = min(SPLIT_ZOOMS, zoom - level[0][0].z)
+            next_level = []
+            for tile, path in level:
+                LOG.debug('Splitting {0} into zoom {1} shards'.format(path, tile.z + step))
+                next_level += split(path, descendants(tile, tile.z + step), work)
+                if path != planet:
+                    os.remove(path)
+            level = next_level
+
+        index = {
+            'planet': planet,
+            'sequence': str(sequence),
+            'zoom': zoom,
+            'shards': {tile_key(t): basename(path) for t, path in level},
+        }
+        with open(join(work, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        os.rename(work, target)
+    finally:
+        shutil.rmtree(work, True)
+
+    shard_sets = sorted(
+        (join(settings.PLANET_SHARD_DIR, d) for d in os.listdir(settings.PLANET_SHARD_DIR)),
+        key=os.path.getmtime)
+    for old in shard_sets[:-KEEP_SHARD_SETS]:
+        if isfile(join(old, 'index.json')) and old != target:
+            shutil.rmtree(old, True)
+    return target
+
+
+def load_index(planet):
+    if not settings.PLANET_SHARD_DIR:
+        return None
+    directory = shard_dir(planet_sequence(planet))
+    try:
+        with open(join(directory, 'index.json')) as f:
+            return directory, json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def shard_path(planet, geom, tempdir):
+    """
+    Path to read an extract of geom from: the one shard it falls in,
+    the intersecting shards merged into tempdir, or the planet itself
+    when there is no shard set for it or the region covers too much of it.
+    """
+    loaded = load_index(planet)
+    if loaded is None:
+        return planet
+    directory, index = loaded
+    tiles = shard_tiles(geom, index['zoom'])
+    if not tiles or len(tiles) > len(index['shards']) // 4:
+        return planet
+    paths = [join(directory, index['shards'][tile_key(t)]) for t in tiles]
+    if len(paths) == 1:
+        return paths[0]
+    merged = join(tempdir, 'shards.osm.pbf')
+    LOG.debug('Merging {0} planet shards'.format(len(paths)))
+    subprocess.check_call(['osmium', 'merge', *paths, '-o', merged, '--overwrite'])
+    return merged
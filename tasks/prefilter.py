@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Cut a source down to the objects a mapping's themes could match before
+the tabular pass reads it.
+
+Every theme's where clause only matches objects carrying at least one of
+a few keys, so `osmium tags-filter` on those keys (which keeps the nodes
+and members the kept objects reference) gives the handler the same
+matches from a much smaller file. Clauses that can match an object
+without any particular key, such as `key != 'value'`, turn the filter off.
+"""
+import os
+import re
+import subprocess
+from os.path import getsize
+
+# characters osmium reads as part of a filter expression rather than a key
+SPECIAL = re.compile(r'[,=*/!]')
+
+# a filter keeping more than this share of the source isn't worth a second copy
+MAX_SHARE = 0.9
+
+
+def required_keys(expr):
+    """Keys of which a matching object must carry at least one, or None if there are none."""
+    if len(expr) == 0:
+        return set()
+    op = expr[0]
+    if op == 'or':
+        left, right = required_keys(expr[1]), required_keys(expr[2])
+        if left is None or right is None:
+            return None
+        return left | right
+    if op == 'and':
+        # either side alone already restricts the matches
+        left, right = required_keys(expr[1]), required_keys(expr[2])
+        if left is None or right is None:
+            return right if left is None else left
+        return left if len(left) <= len(right) else right
+    if op == '!=':
+        return None
+    return {expr[1]}
+
+
+def filter_expressions(mapping):
+    """osmium tags-filter expressions covering every theme, or None if no filter applies."""
+    keys = {'n': set(), 'w': set(), 'r': set()}
+    for theme in mapping.themes:
+        theme_keys = required_keys(theme.matcher.expr)
+        if theme_keys is None or any(SPECIAL.search(k) for k in theme_keys):
+            return None
+        if theme.points:
+            keys['n'] |= theme_keys
+        if theme.lines:
+            keys['w'] |= theme_keys
+        if theme.polygons:
+            # closed ways and multipolygon relations
+            keys['w'] |= theme_keys
+            keys['r'] |= theme_keys
+    return ['{0}/{1}'.format(kind, ','.join(sorted(k))) for kind, k in sorted(keys.items()) if k]
+
+
+def prefilter(source_path, mapping, output_path):
+    """Path to read mapping's themes from: output_path cut from source_path, or source_path itself."""
+    expressions = filter_expressions(mapping)
+    if not expressions:
+        return source_path
+    subprocess.check_call(['osmium', 'tags-filter', source_path] + expressions + ['-o', output_path, '--overwrite'])
+    if getsize(output_path) > MAX_SHARE * getsize(source_path):
+        os.remove(output_path)
+        return source_path
+    return output_path
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Per-day rollups of jobs, users and runs for the stats endpoints.
+
+Whole past days are read from DailyStats rows, which are computed the
+first time they are asked for and recomputed after being marked stale.
+The partial days at either end of a range, and today, are counted live,
+so a request costs a handful of grouped queries whatever the history size.
+"""
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.db.models import Count, Exists, OuterRef
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+
+from jobs.models import HDXExportRegion, Job
+from .models import DailyStats, ExportRun
+
+COUNTERS = ('regions', 'run_types', 'hdx_run_status', 'normal_run_status', 'export_formats')
+
+
+def empty():
+    stats = {'jobs_count': 0, 'users_count': 0, 'runs_count': 0}
+    for name in COUNTERS:
+        stats[name] = Counter()
+    return stats
+
+
+def count(start, end, inclusive=False):
+    """{date: stats} for everything in [start, end), or [start, end] if inclusive."""
+    end_lookup = 'lte' if inclusive else 'lt'
+
+    def between(field):
+        return {field + '__gte': start, '{0}__{1}'.format(field, end_lookup): end}
+
+    days = {}
+
+    def day(t):
+        return days.setdefault(t.date(), empty())
+
+    jobs = Job.objects.filter(**between('created_at')) \
+        .annotate(day=TruncDay('created_at')).values('day', 'country').annotate(count=Count('id')).order_by()
+    for row in jobs:
+        stats = day(row['day'])
+        stats['jobs_count'] += row['count']
+        if row['country']:
+            stats['regions'][row['country']] += row['count']
+
+    users = User.objects.filter(**between('date_joined')) \
+        .annotate(day=TruncDay('date_joined')).values('day').annotate(count=Count('id')).order_by()
+    for row in users:
+        day(row['day'])['users_count'] += row['count']
+
+    runs = ExportRun.objects.filter(**between('started_at')) \
+        .annotate(day=TruncDay('started_at'), hdx=Exists(HDXExportRegion.objects.filter(job_id=OuterRef('job_id')))) \
+        .values('day', 'hdx', 'status', 'job__export_formats').annotate(count=Count('id')).order_by()
+    for row in runs:
+        stats = day(row['day'])
+        stats['runs_count'] += row['count']
+        status = row['status'].lower()
+        if row['hdx']:
+            stats['run_types']['hdx_run'] += row['count']
+            stats['hdx_run_status'][status] += row['count']
+        else:
+            stats['run_types']['on_demand'] += row['count']
+            stats['normal_run_status'][status] += row['count']
+        for f in row['job__export_formats']:
+            stats['export_formats'][str(f)] += row['count']
+
+    return days
+
+
+def load(stats):
+    stats = dict(stats)
+    for name in COUNTERS:
+        stats[name] = Counter(stats[name])
+    return stats
+
+
+def stored(first, last):
+    """{date: stats} for the whole days first to last, computing missing or stale rows."""
+    days = {
+        row.day: load(row.stats)
+        for row in DailyStats.objects.filter(day__gte=first, day__lte=last, stale=False)
+    }
+    missing = []
+    d = first
+    while d <= last:
+        if d not in days:
+            missing.append(d)
+        d += timedelta(days=1)
+    if not missing:
+        return days
+
+    start = timezone.make_aware(datetime.combine(missing[0], time()))
+    end = timezone.make_aware(datetime.combine(missing[-1] + timedelta(days=1), time()))
+    counted = count(start, end)
+    for d in missing:
+        days[d] = counted.get(d, empty())
+        DailyStats.objects.update_or_create(day=d, defaults={'stats': days[d], 'stale': False})
+    return days
+
+
+def daily_stats(after, before):
+    """{date: stats} for jobs, users and runs between two aware datetimes, inclusive."""
+    after, before = after.astimezone(timezone.utc), before.astimezone(timezone.utc)
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    first = after.replace(hour=0, minute=0, second=0, microsecond=0)
+    if first < after:
+        first += timedelta(days=1)
+    # whole days end before this, which is also where counting live starts again
+    last_end = min(before.replace(hour=0, minute=0, second=0, microsecond=0), today)
+    if first >= last_end:
+        return count(after, before, inclusive=True)
+
+    days = count(after, first)
+    days.update(stored(first.date(), (last_end - timedelta(days=1)).date()))
+    for d, stats in count(last_end, before, inclusive=True).items():
+        merge(days.setdefault(d, empty()), stats)
+    return days
+
+
+def merge(total, stats):
+    for name, value in stats.items():
+        total[name] += value
+    return total
+
+
+def by_period(days, period_fn):
+    """Fold daily stats into periods keyed by period_fn(day)."""
+    periods = {}
+    for d, stats in days.items():
+        merge(periods.setdefault(period_fn(d), empty()), stats)
+    return periods
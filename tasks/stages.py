@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing of export runs.
+
+run_task records each stage (source download, apply_file, Galaxy fetches,
+packaging, HDX sync, cleanup) as an ExportRunStage row with its wall time,
+bytes read and written and the worker's peak resident memory during it.
+"""
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from .models import ExportRunStage
+
+LOG = logging.getLogger(__name__)
+
+
+def path_size(paths):
+    """Total size in bytes of a path or a list of paths; missing files count as 0."""
+    if isinstance(paths, str):
+        paths = [paths]
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes since the last reset."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageRecorder(object):
+    def __init__(self, run):
+        self.run = run
+
+    @contextmanager
+    def stage(self, name, bytes_in=None):
+        """
+        Time the enclosed block as one stage.
+        The yielded ExportRunStage can be given bytes_out before the block ends.
+        """
+        reset_peak_rss()
+        stage = ExportRunStage(run=self.run, name=name, started_at=timezone.now(), bytes_in=bytes_in)
+        start = time.monotonic()
+        try:
+            yield stage
+        except Exception:
+            stage.failed = True
+            raise
+        finally:
+            stage.duration = time.monotonic() - start
+            stage.peak_rss = peak_rss()
+            self.save(stage)
+
+    def record(self, name, started_at, duration, bytes_out=None, failed=False):
+        """Record a stage timed elsewhere, e.g. in a worker thread."""
+        self.save(ExportRunStage(run=self.run, name=name, started_at=started_at,
+            duration=duration, bytes_out=bytes_out, failed=failed))
+
+    def save(self, stage):
+        # timing must never fail the run it measures
+        try:
+            stage.save()
+        except Exception as ex:
+            LOG.warn('Could not record stage {0} for run {1}: {2}'.format(stage.name, self.run.uid, ex))
@@ -6,8 +6,10 @@ import os
 from os.path import join, exists, basename
 import json
 import shutil
+import time
 import zipfile
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import django
 from dramatiq.middleware import TimeLimitExceeded
@@ -32,12 +34,12 @@ from django.utils.text import get_valid_filename
 from jobs.models import Job, HDXExportRegion, PartnerExportRegion
 from tasks.models import ExportRun, ExportTask
 from hdx_exports.hdx_export_set import slugify, sync_region
+from utils.aoi_utils import to_shapely
+from utils.feature_selection import compiled_mapping
 
 import osm_export_tool
 import osm_export_tool.tabular as tabular
 import osm_export_tool.nontabular as nontabular
-from osm_export_tool.mapping import Mapping
-from osm_export_tool.geometry import load_geometry
 from osm_export_tool.sources import Overpass, OsmiumTool, Galaxy
 from osm_export_tool.package import create_package, create_posm_bundle
 
@@ -51,6 +53,13 @@ from .email import (
 )
 
 from .pdc import run_pdc_task
+from . import galaxy
+from .clipping import ClippingHandler
+from .parallel_tabular import apply_file as apply_tabular
+from .prefilter import prefilter
+from .theme_index import IndexedHandler
+from .extract_cache import cached_extract_path, current_planet
+from .stages import StageRecorder, path_size
 
 client = Client()
 
@@ -140,10 +149,28 @@ def run_task_async_scheduled(run_uid):
         run.save()
     db.close_old_connections()
 
+@dramatiq.actor(max_retries=0,queue_name='scheduled',time_limit=1000*60*60*12) #  12 hour
+def batch_extract_and_run(job_uids):
+    # one planet pass for every planet-backed region due this hour, then queue the runs as usual
+    from .batch_extract import extract_regions
+    try:
+        regions = list(HDXExportRegion.objects.filter(job__uid__in=job_uids)) + \
+            list(PartnerExportRegion.objects.filter(job__uid__in=job_uids))
+        extract_regions(regions)
+    except Exception:
+        client.captureException(extra={'job_uids': job_uids})
+        LOG.warn('Batch planet extraction failed, runs will extract on their own.')
+        LOG.warn(traceback.format_exc())
+    for job_uid in job_uids:
+        ExportTaskRunner().run_task(job_uid=job_uid,ondemand=False)
+    db.close_old_connections()
+
 def run_task_remote(run_uid):
     stage_dir=None
+    stages=None
     try:
         run = ExportRun.objects.get(uid=run_uid)
+        stages = StageRecorder(run)
         run.status = 'RUNNING'
         run.started_at = timezone.now()
         run.save()
@@ -154,7 +181,7 @@ def run_task_remote(run_uid):
         if not exists(download_dir):
             os.makedirs(download_dir)
 
-        run_task(run_uid,run,stage_dir,download_dir)
+        run_task(run_uid,run,stage_dir,download_dir,stages)
 
     except (Job.DoesNotExist,ExportRun.DoesNotExist,ExportTask.DoesNotExist):
 
@@ -164,6 +191,7 @@ def run_task_remote(run_uid):
         run = ExportRun.objects.get(uid=run_uid)
         run.status = 'FAILED'
         run.finished_at = timezone.now()
+        run.update_sizes()
         run.save()
 
         if HDXExportRegion.objects.filter(job_id=run.job_id).exists():
@@ -172,16 +200,22 @@ def run_task_remote(run_uid):
         LOG.warn(traceback.format_exc())
     finally:
         if stage_dir:
-            shutil.rmtree(stage_dir)
+            if stages:
+                with stages.stage('cleanup'):
+                    shutil.rmtree(stage_dir)
+            else:
+                shutil.rmtree(stage_dir)
 
-def run_task(run_uid,run,stage_dir,download_dir):
+def run_task(run_uid,run,stage_dir,download_dir,stages=None):
     LOG.debug('Running ExportRun with id: {0}'.format(run_uid))
+    if stages is None:
+        stages = StageRecorder(run)
     job = run.job
     valid_name = get_valid_filename(job.name)
 
-    geom = load_geometry(job.simplified_geom.json)
+    geom = to_shapely(job.simplified_geom)
     export_formats = job.export_formats
-    mapping = Mapping(job.feature_selection)
+    mapping = compiled_mapping(job.feature_selection)
 
     def start_task(name):
 
@@ -219,6 +253,102 @@ def run_task(run_uid,run,stage_dir,download_dir):
                     total_bytes += file.size()
                 task.filesize_bytes = total_bytes
         task.save()
+        run.save_sizes()
+
+    def fetch_galaxy_outputs(fetches, **fetch_kwargs):
+        # submit every raw-data API request for this run at once;
+        # each fetch is (task name, Galaxy source, output format)
+        if not fetches:
+            return []
+        results = {}
+        timings = {}
+        error = None
+
+        def timed_fetch(name, source, output_format):
+            # stages are saved from this thread only, the fetch threads just time
+            started_at, start = timezone.now(), time.monotonic()
+            try:
+                return source.fetch(output_format, **fetch_kwargs)
+            finally:
+                timings[name] = (started_at, time.monotonic() - start)
+
+        max_workers = min(settings.GALAXY_FETCH_CONCURRENCY, len(fetches))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for name, source, output_format in fetches:
+                LOG.debug('Galaxy fetch started for {0} run: {1}'.format(name, run_uid))
+                futures[executor.submit(timed_fetch, name, source, output_format)] = name
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    response_back = future.result()
+                    stages.record('galaxy:' + name, *timings[name],
+                        bytes_out=sum(int(r['zip_file_size_bytes']) for r in response_back))
+                    for r in response_back:
+                        size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
+                        with open(size_path, 'w') as f:
+                            f.write(str(r['zip_file_size_bytes']))
+                    LOG.debug('Galaxy fetch ended for {0} run: {1}'.format(name, run_uid))
+                    finish_task(name,response_back=response_back)
+                    results[name] = response_back
+                except Exception as ex:
+                    if name in timings:
+                        stages.record('galaxy:' + name, *timings[name], failed=True)
+                    stop_task(name)
+                    error = error or ex
+        if error:
+            raise error
+        # keep the submission order so downstream consumers see a stable file list
+        return [r for name, _, _ in fetches for r in results[name]]
+
+    def fetch_single_extract(fetches, add_metadata=None, **fetch_kwargs):
+        # fetches that only differ in output format share one raw data API
+        # extraction (a geopackage), re-encoded locally for the other formats
+        names = [name for name, _, _ in fetches]
+        source = fetches[0][1]
+        LOG.debug('Galaxy single extract started for {0} run: {1}'.format(','.join(names), run_uid))
+        try:
+            with stages.stage('galaxy:extract') as stage:
+                response_back = source.fetch('gpkg', **fetch_kwargs)
+                extracts = galaxy.download_extract(response_back, stage_dir)
+                stage.bytes_out = path_size([gpkg for _, gpkgs in extracts for gpkg in gpkgs])
+        except Exception as ex:
+            for name in names:
+                stop_task(name)
+            raise ex
+        LOG.debug('Galaxy single extract ended for run: {0}'.format(run_uid))
+
+        def theme_metadata(z, theme_name):
+            theme = [t for t in mapping.themes if t.name == theme_name][0]
+            add_metadata(z, theme)
+
+        outputs = []
+        for name in names:
+            try:
+                if name == 'geopackage':
+                    for r in response_back:
+                        size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
+                        with open(size_path, 'w') as f:
+                            f.write(str(r['zip_file_size_bytes']))
+                    finish_task(name,response_back=response_back)
+                    outputs += response_back
+                else:
+                    with stages.stage('convert:' + name) as stage:
+                        zips = galaxy.convert_extract(extracts, name, stage_dir, download_dir,
+                            add_metadata=theme_metadata if add_metadata else None)
+                        stage.bytes_out = sum(z.size() for z in zips)
+                    finish_task(name,zips)
+                    outputs += zips
+            except Exception as ex:
+                stop_task(name)
+                raise ex
+        return outputs
+
+    def split_single_extract(fetches):
+        batched = [f for f in fetches if f[0] in galaxy.SINGLE_EXTRACT_FORMATS]
+        if settings.GALAXY_SINGLE_EXTRACT and len(batched) > 1:
+            return batched, [f for f in fetches if f not in batched]
+        return [], fetches
 
     is_hdx_export = HDXExportRegion.objects.filter(job_id=run.job_id).exists()
     is_partner_export = PartnerExportRegion.objects.filter(job_id=run.job_id).exists()
@@ -226,7 +356,6 @@ def run_task(run_uid,run,stage_dir,download_dir):
     planet_file = False
     polygon_centroid = False
     use_only_galaxy = False
-    all_feature_filter_json = None
 
     galaxy_supported_outputs = ['geojson','geopackage','kml','shp','fgb','csv','sql']
     if galaxy_supported_outputs == list(export_formats) or set(export_formats).issubset(set(galaxy_supported_outputs)):
@@ -244,7 +373,7 @@ def run_task(run_uid,run,stage_dir,download_dir):
         # Run PDC special task.
         if export_region.group.name == "PDC" and planet_file is True and polygon_centroid is True:
             params = {
-                "PLANET_FILE": settings.PLANET_FILE,
+                "PLANET_FILE": current_planet(),
                 "MAPPING": mapping,
                 "STAGE_DIR": stage_dir,
                 "DOWNLOAD_DIR": download_dir,
@@ -254,7 +383,8 @@ def run_task(run_uid,run,stage_dir,download_dir):
             if "geopackage" not in export_formats:
                 raise ValueError("geopackage must be the export format")
 
-            paths = run_pdc_task(params)
+            with stages.stage('pdc'):
+                paths = run_pdc_task(params)
 
             start_task("geopackage")
             target = join(download_dir, "{}.gpkg".format(valid_name))
@@ -323,19 +453,31 @@ def run_task(run_uid,run,stage_dir,download_dir):
             start_task('csv')
 
         if planet_file:
-            h = tabular.Handler(tabular_outputs,mapping,polygon_centroid=polygon_centroid)
-            source = OsmiumTool('osmium',settings.PLANET_FILE,geom,join(stage_dir,'extract.osm.pbf'),tempdir=stage_dir)
+            h = IndexedHandler(tabular_outputs,mapping,polygon_centroid=polygon_centroid)
+            source = OsmiumTool('osmium',current_planet(),geom,join(stage_dir,'extract.osm.pbf'),tempdir=stage_dir)
 
         else:
             if use_only_galaxy == False :
-                h = tabular.Handler(tabular_outputs,mapping,clipping_geom=geom,polygon_centroid=polygon_centroid)
+                h = ClippingHandler(tabular_outputs,mapping,clipping_geom=geom,polygon_centroid=polygon_centroid)
                 source = Overpass(settings.OVERPASS_API_URL,geom,join(stage_dir,'overpass.osm.pbf'),tempdir=stage_dir,use_curl=True,mapping=mapping_filter)
 
         if use_only_galaxy == False :
             LOG.debug('Source start for run: {0}'.format(run_uid))
-            source_path = source.path()
+            with stages.stage('source') as stage:
+                if planet_file:
+                    source_path = cached_extract_path(source,join(stage_dir,'extract.osm.pbf'),geom)
+                else:
+                    source_path = source.path()
+                stage.bytes_out = path_size(source_path)
             LOG.debug('Source end for run: {0}'.format(run_uid))
-            h.apply_file(source_path, locations=True, idx='sparse_file_array')
+            tabular_path = source_path
+            # sources built with the mapping are already filtered to it
+            if h.outputs and getattr(source, 'mapping', None) is None:
+                with stages.stage('prefilter', bytes_in=path_size(source_path)) as stage:
+                    tabular_path = prefilter(source_path, mapping, join(stage_dir, 'tabular.osm.pbf'))
+                    stage.bytes_out = path_size(tabular_path)
+            with stages.stage('apply_file', bytes_in=path_size(tabular_path)) as stage:
+                stage.detail = apply_tabular(h, tabular_path, geom, job.feature_selection, stage_dir)
 
         all_zips = []
 
@@ -344,56 +486,29 @@ def run_task(run_uid,run,stage_dir,download_dir):
             for key in theme.keys:
                 columns.append('{0} http://wiki.openstreetmap.org/wiki/Key:{0}'.format(key))
             columns = '\n'.join(columns)
-            readme = ZIP_README.format(criteria=theme.matcher.to_sql(),columns=columns)
+            readme = ZIP_README.format(criteria=mapping.criteria[theme.name],columns=columns)
             z.writestr("README.txt", readme)
 
-        if geojson :
-            try:
-                LOG.debug('Galaxy fetch started geojson for run: {0}'.format(run_uid))
-                response_back=geojson.fetch('geojson',is_hdx_export=True)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for geojson run: {0}'.format(run_uid))
-                finish_task('geojson',response_back=response_back)
-                all_zips += response_back
-            except Exception as ex :
-                stop_task('geojson')
-                raise ex
-
-        if csv :
+        galaxy_fetches = []
+        if geojson:
+            galaxy_fetches.append(('geojson', geojson, 'geojson'))
+        if csv:
+            galaxy_fetches.append(('csv', csv, 'csv'))
+        if settings.USE_RAW_DATA_API_FOR_HDX:
+            if geopackage:
+                galaxy_fetches.append(('geopackage', geopackage, 'gpkg'))
+            if shp:
+                galaxy_fetches.append(('shp', shp, 'shp'))
+            if kml:
+                galaxy_fetches.append(('kml', kml, 'kml'))
+        batched, galaxy_fetches = split_single_extract(galaxy_fetches)
+        if batched:
+            all_zips += fetch_single_extract(batched, add_metadata=add_metadata, is_hdx_export=True)
+        all_zips += fetch_galaxy_outputs(galaxy_fetches, is_hdx_export=True)
+
+        if geopackage and not settings.USE_RAW_DATA_API_FOR_HDX:
             try:
-                LOG.debug('Galaxy fetch started for csv run: {0}'.format(run_uid))
-                response_back=csv.fetch('csv',is_hdx_export=True)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for csv run: {0}'.format(run_uid))
-                finish_task('csv',response_back=response_back)
-                all_zips += response_back
-
-            except Exception as ex :
-                stop_task('csv')
-                raise ex
-
-        if geopackage:
-            try:
-                if settings.USE_RAW_DATA_API_FOR_HDX:
-                    LOG.debug('Galaxy fetch started for geopackage run: {0}'.format(run_uid))
-                    response_back=geopackage.fetch('gpkg',is_hdx_export=True)
-                    for r in response_back:
-                        size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                        with open(size_path, 'w') as f:
-                            f.write(str(r['zip_file_size_bytes']))
-                    LOG.debug('Galaxy fetch ended for geopackage run: {0}'.format(run_uid))
-                    finish_task('geopackage',response_back=response_back)
-                    all_zips += response_back
-
-                else:
+                with stages.stage('package:geopackage') as stage:
                     geopackage.finalize()
                     zips = []
                     for theme in mapping.themes:
@@ -405,26 +520,16 @@ def run_task(run_uid,run,stage_dir,download_dir):
                                 for part in file.parts:
                                     z.write(part, os.path.basename(part))
                         zips.append(osm_export_tool.File('geopackage',[destination],{'theme':theme.name}))
-                    finish_task('geopackage',zips)
-                    all_zips += zips
+                    stage.bytes_out = sum(z.size() for z in zips)
+                finish_task('geopackage',zips)
+                all_zips += zips
             except Exception as ex :
                 stop_task('geopackage')
                 raise ex
 
-        if shp:
+        if shp and not settings.USE_RAW_DATA_API_FOR_HDX:
             try:
-                if settings.USE_RAW_DATA_API_FOR_HDX:
-                    LOG.debug('Galaxy fetch started for shp run: {0}'.format(run_uid))
-
-                    response_back=shp.fetch('shp',is_hdx_export=True)
-                    for r in response_back:
-                        size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-                        with open(size_path, 'w') as f:
-                            f.write(str(r['zip_file_size_bytes']))
-                    LOG.debug('Galaxy fetch ended  for shp run: {0}'.format(run_uid))
-                    finish_task('shp',response_back=response_back)
-                    all_zips += response_back
-                else:
+                with stages.stage('package:shp') as stage:
                     shp.finalize()
                     zips = []
                     for file in shp.files:
@@ -438,26 +543,16 @@ def run_task(run_uid,run,stage_dir,download_dir):
                             for part in file.parts:
                                 z.write(part, os.path.basename(part))
                         zips.append(osm_export_tool.File('shp',[destination],{'theme':file.extra['theme']}))
-                    finish_task('shp',zips)
-                    all_zips += zips
+                    stage.bytes_out = sum(z.size() for z in zips)
+                finish_task('shp',zips)
+                all_zips += zips
             except Exception as ex:
                 stop_task('shp')
                 raise ex
-        if kml:
-            try:
-                if settings.USE_RAW_DATA_API_FOR_HDX:
-                    LOG.debug('Galaxy fetch started for kml run: {0}'.format(run_uid))
-                    response_back=kml.fetch('kml',is_hdx_export=True)
-                    for r in response_back:
-                        size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
 
-                        with open(size_path, 'w') as f:
-                            f.write(str(r['zip_file_size_bytes']))
-                    LOG.debug('Galaxy fetch ended for kml run: {0}'.format(run_uid))
-                    finish_task('kml',response_back=response_back)
-                    all_zips += response_back
-
-                else: # use overpass
+        if kml and not settings.USE_RAW_DATA_API_FOR_HDX:
+            try:
+                with stages.stage('package:kml') as stage:
                     kml.finalize()
                     zips = []
                     for file in kml.files:
@@ -468,8 +563,9 @@ def run_task(run_uid,run,stage_dir,download_dir):
                             for part in file.parts:
                                 z.write(part, os.path.basename(part))
                         zips.append(osm_export_tool.File('kml',[destination],{'theme':file.extra['theme']}))
-                    finish_task('kml',zips)
-                    all_zips += zips
+                    stage.bytes_out = sum(z.size() for z in zips)
+                finish_task('kml',zips)
+                all_zips += zips
             except Exception as ex :
                 stop_task('kml')
                 raise ex
@@ -477,9 +573,11 @@ def run_task(run_uid,run,stage_dir,download_dir):
         if 'garmin_img' in export_formats:
             start_task('garmin_img')
             try:
-                garmin_files = nontabular.garmin(source_path,settings.GARMIN_SPLITTER,settings.GARMIN_MKGMAP,tempdir=stage_dir)
-                zipped = create_package(join(download_dir,valid_name + '_gmapsupp_img.zip'),garmin_files,boundary_geom=geom,output_name='garmin_img')
-                all_zips.append(zipped)
+                with stages.stage('package:garmin_img', bytes_in=path_size(source_path)) as stage:
+                    garmin_files = nontabular.garmin(source_path,settings.GARMIN_SPLITTER,settings.GARMIN_MKGMAP,tempdir=stage_dir)
+                    zipped = create_package(join(download_dir,valid_name + '_gmapsupp_img.zip'),garmin_files,boundary_geom=geom,output_name='garmin_img')
+                    all_zips.append(zipped)
+                    stage.bytes_out = zipped.size()
                 finish_task('garmin_img',[zipped])
             except Exception as ex :
                 stop_task('garmin_img')
@@ -490,7 +588,8 @@ def run_task(run_uid,run,stage_dir,download_dir):
             region = HDXExportRegion.objects.get(job_id=run.job_id)
             try:
                 public_dir = settings.HOSTNAME + join(settings.EXPORT_MEDIA_ROOT, run_uid)
-                sync_region(region,all_zips,public_dir)
+                with stages.stage('hdx_sync'):
+                    sync_region(region,all_zips,public_dir)
                 run.hdx_sync_status = True
             except Exception as ex:
                 run.sync_status = False
@@ -512,7 +611,7 @@ def run_task(run_uid,run,stage_dir,download_dir):
         if 'geojson' in export_formats:
             preserved_geom=geom
             if job.preserve_geom :
-                preserved_geom = load_geometry(job.the_geom.json)
+                preserved_geom = to_shapely(job.the_geom)
             geojson = Galaxy(settings.RAW_DATA_API_URL,preserved_geom,mapping=mapping_filter,file_name=valid_name)
             start_task('geojson')
 
@@ -544,140 +643,68 @@ def run_task(run_uid,run,stage_dir,download_dir):
             # tabular_outputs.append(kml)
             start_task('kml')
         if planet_file:
-            h = tabular.Handler(tabular_outputs,mapping,polygon_centroid=polygon_centroid)
-            source = OsmiumTool('osmium',settings.PLANET_FILE,geom,join(stage_dir,'extract.osm.pbf'),tempdir=stage_dir, mapping=mapping)
+            h = IndexedHandler(tabular_outputs,mapping,polygon_centroid=polygon_centroid)
+            source = OsmiumTool('osmium',current_planet(),geom,join(stage_dir,'extract.osm.pbf'),tempdir=stage_dir, mapping=mapping)
         else:
             if use_only_galaxy == False :
-                h = tabular.Handler(tabular_outputs,mapping,clipping_geom=geom,polygon_centroid=polygon_centroid)
+                h = ClippingHandler(tabular_outputs,mapping,clipping_geom=geom,polygon_centroid=polygon_centroid)
                 source = Overpass(settings.OVERPASS_API_URL,geom,join(stage_dir,'overpass.osm.pbf'),tempdir=stage_dir,use_curl=True,mapping=mapping_filter)
         if use_only_galaxy == False :
             LOG.debug('Source start for run: {0}'.format(run_uid))
-            source_path = source.path()
+            with stages.stage('source') as stage:
+                if planet_file:
+                    source_path = cached_extract_path(source,join(stage_dir,'extract.osm.pbf'),geom,job.feature_selection)
+                else:
+                    source_path = source.path()
+                stage.bytes_out = path_size(source_path)
             LOG.debug('Source end for run: {0}'.format(run_uid))
 
-            h.apply_file(source_path, locations=True, idx='sparse_file_array')
+            tabular_path = source_path
+            # sources built with the mapping are already filtered to it
+            if h.outputs and getattr(source, 'mapping', None) is None:
+                with stages.stage('prefilter', bytes_in=path_size(source_path)) as stage:
+                    tabular_path = prefilter(source_path, mapping, join(stage_dir, 'tabular.osm.pbf'))
+                    stage.bytes_out = path_size(tabular_path)
+            with stages.stage('apply_file', bytes_in=path_size(tabular_path)) as stage:
+                stage.detail = apply_tabular(h, tabular_path, geom, job.feature_selection, stage_dir)
 
         bundle_files = []
 
-        if geojson :
-            try:
-                LOG.debug('Galaxy fetch started for geojson run: {0}'.format(run_uid))
-                all_feature_filter_json=join(os.getcwd(),'tasks/tests/fixtures/all_features_filters.json')
-                response_back=geojson.fetch('geojson',all_feature_filter_json=all_feature_filter_json)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for geojson run: {0}'.format(run_uid))
-                finish_task('geojson',response_back=response_back)
-            except Exception as ex :
-                stop_task('geojson')
-                raise ex
-
-        if fgb :
-            try:
-                LOG.debug('Galaxy fetch started for fgb run: {0}'.format(run_uid))
-                all_feature_filter_json=join(os.getcwd(),'tasks/tests/fixtures/all_features_filters.json')
-                response_back=fgb.fetch('fgb',all_feature_filter_json=all_feature_filter_json)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for fgb run: {0}'.format(run_uid))
-                finish_task('fgb',response_back=response_back)
-            except Exception as ex :
-                stop_task('fgb')
-                raise ex
-
-        if csv :
-            try:
-                LOG.debug('Galaxy fetch started for csv run: {0}'.format(run_uid))
-                all_feature_filter_json=join(os.getcwd(),'tasks/tests/fixtures/all_features_filters.json')
-                response_back=csv.fetch('csv',all_feature_filter_json=all_feature_filter_json)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for csv run: {0}'.format(run_uid))
-                finish_task('csv',response_back=response_back)
-            except Exception as ex :
-                stop_task('csv')
-                raise ex
-
-        if sql :
-            try:
-                LOG.debug('Galaxy fetch started for sql run: {0}'.format(run_uid))
-                all_feature_filter_json=join(os.getcwd(),'tasks/tests/fixtures/all_features_filters.json')
-                response_back=sql.fetch('sql',all_feature_filter_json=all_feature_filter_json)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for sql run: {0}'.format(run_uid))
-                finish_task('sql',response_back=response_back)
-            except Exception as ex :
-                stop_task('sql')
-                raise ex
-
-
+        galaxy_fetches = []
+        if geojson:
+            galaxy_fetches.append(('geojson', geojson, 'geojson'))
+        if fgb:
+            galaxy_fetches.append(('fgb', fgb, 'fgb'))
+        if csv:
+            galaxy_fetches.append(('csv', csv, 'csv'))
+        if sql:
+            galaxy_fetches.append(('sql', sql, 'sql'))
         if geopackage:
-            try :
-                LOG.debug('Galaxy fetch started for geopackage run: {0}'.format(run_uid))
-                all_feature_filter_json=join(os.getcwd(),'tasks/tests/fixtures/all_features_filters.json')
-                response_back=geopackage.fetch('gpkg',all_feature_filter_json=all_feature_filter_json)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for geopackage run: {0}'.format(run_uid))
-                finish_task('geopackage',response_back=response_back)
-            except Exception as ex :
-                stop_task('geopackage')
-                raise ex
-
+            galaxy_fetches.append(('geopackage', geopackage, 'gpkg'))
         if shp:
-            try :
-                LOG.debug('Galaxy fetch started for shp run:  {0}'.format(run_uid))
-                response_back=shp.fetch('shp',all_feature_filter_json=all_feature_filter_json)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for shp run:  {0}'.format(run_uid))
-                finish_task('shp',response_back=response_back)
-            except Exception as ex :
-                stop_task('shp')
-                raise ex
-
+            galaxy_fetches.append(('shp', shp, 'shp'))
         if kml:
-            try :
-                LOG.debug('Galaxy fetch started for kml run: {0}'.format(run_uid))
-                all_feature_filter_json=join(os.getcwd(),'tasks/tests/fixtures/all_features_filters.json')
-                response_back=kml.fetch('kml',all_feature_filter_json=all_feature_filter_json)
-                for r in response_back:
-                    size_path=join(download_dir,f"{r['download_url'].split('/')[-1]}_size.txt")
-
-                    with open(size_path, 'w') as f:
-                        f.write(str(r['zip_file_size_bytes']))
-                LOG.debug('Galaxy fetch ended for kml run: {0}'.format(run_uid))
-                finish_task('kml',response_back=response_back)
-
-            except Exception as ex :
-                stop_task('kml')
-                raise ex
+            galaxy_fetches.append(('kml', kml, 'kml'))
+        all_feature_filter_json=join(os.getcwd(),'tasks/tests/fixtures/all_features_filters.json')
+        if job.preserve_geom:
+            # geojson is extracted with the unsimplified geometry, it can't share the extract
+            batched, galaxy_fetches = split_single_extract([f for f in galaxy_fetches if f[0] != 'geojson'])
+            if geojson:
+                galaxy_fetches.append(('geojson', geojson, 'geojson'))
+        else:
+            batched, galaxy_fetches = split_single_extract(galaxy_fetches)
+        if batched:
+            fetch_single_extract(batched, all_feature_filter_json=all_feature_filter_json)
+        fetch_galaxy_outputs(galaxy_fetches, all_feature_filter_json=all_feature_filter_json)
 
         if 'garmin_img' in export_formats:
             start_task('garmin_img')
             try :
-                garmin_files = nontabular.garmin(source_path,settings.GARMIN_SPLITTER,settings.GARMIN_MKGMAP,tempdir=stage_dir)
-                bundle_files += garmin_files
-                zipped = create_package(join(download_dir,valid_name + '_gmapsupp_img.zip'),garmin_files,boundary_geom=geom)
+                with stages.stage('package:garmin_img', bytes_in=path_size(source_path)) as stage:
+                    garmin_files = nontabular.garmin(source_path,settings.GARMIN_SPLITTER,settings.GARMIN_MKGMAP,tempdir=stage_dir)
+                    bundle_files += garmin_files
+                    zipped = create_package(join(download_dir,valid_name + '_gmapsupp_img.zip'),garmin_files,boundary_geom=geom)
+                    stage.bytes_out = zipped.size()
                 finish_task('garmin_img',[zipped])
             except Exception as ex :
                 stop_task('garmin_img')
@@ -686,12 +713,14 @@ def run_task(run_uid,run,stage_dir,download_dir):
         if 'mwm' in export_formats:
             start_task('mwm')
             try :
-                mwm_dir = join(stage_dir,'mwm')
-                if not exists(mwm_dir):
-                    os.makedirs(mwm_dir)
-                mwm_files = nontabular.mwm(source_path,mwm_dir,settings.GENERATE_MWM,settings.GENERATOR_TOOL)
-                bundle_files += mwm_files
-                zipped = create_package(join(download_dir,valid_name + '_mwm.zip'),mwm_files,boundary_geom=geom)
+                with stages.stage('package:mwm', bytes_in=path_size(source_path)) as stage:
+                    mwm_dir = join(stage_dir,'mwm')
+                    if not exists(mwm_dir):
+                        os.makedirs(mwm_dir)
+                    mwm_files = nontabular.mwm(source_path,mwm_dir,settings.GENERATE_MWM,settings.GENERATOR_TOOL)
+                    bundle_files += mwm_files
+                    zipped = create_package(join(download_dir,valid_name + '_mwm.zip'),mwm_files,boundary_geom=geom)
+                    stage.bytes_out = zipped.size()
                 finish_task('mwm',[zipped])
             except Exception as ex :
                 stop_task('garmin_img')
@@ -701,9 +730,11 @@ def run_task(run_uid,run,stage_dir,download_dir):
         if 'osmand_obf' in export_formats:
             start_task('osmand_obf')
             try:
-                osmand_files = nontabular.osmand(source_path,settings.OSMAND_MAP_CREATOR_DIR,tempdir=stage_dir)
-                bundle_files += osmand_files
-                zipped = create_package(join(download_dir,valid_name + '_Osmand2_obf.zip'),osmand_files,boundary_geom=geom)
+                with stages.stage('package:osmand_obf', bytes_in=path_size(source_path)) as stage:
+                    osmand_files = nontabular.osmand(source_path,settings.OSMAND_MAP_CREATOR_DIR,tempdir=stage_dir)
+                    bundle_files += osmand_files
+                    zipped = create_package(join(download_dir,valid_name + '_Osmand2_obf.zip'),osmand_files,boundary_geom=geom)
+                    stage.bytes_out = zipped.size()
                 finish_task('osmand_obf',[zipped])
             except Exception as ex :
                 stop_task('osmand_obf')
@@ -712,9 +743,11 @@ def run_task(run_uid,run,stage_dir,download_dir):
         if 'mbtiles' in export_formats:
             start_task('mbtiles')
             try:
-                mbtiles_files = nontabular.mbtiles(geom,join(stage_dir,valid_name + '.mbtiles'),job.mbtiles_source,job.mbtiles_minzoom,job.mbtiles_maxzoom)
-                bundle_files += mbtiles_files
-                zipped = create_package(join(download_dir,valid_name + '_mbtiles.zip'),mbtiles_files,boundary_geom=geom)
+                with stages.stage('package:mbtiles') as stage:
+                    mbtiles_files = nontabular.mbtiles(geom,join(stage_dir,valid_name + '.mbtiles'),job.mbtiles_source,job.mbtiles_minzoom,job.mbtiles_maxzoom)
+                    bundle_files += mbtiles_files
+                    zipped = create_package(join(download_dir,valid_name + '_mbtiles.zip'),mbtiles_files,boundary_geom=geom)
+                    stage.bytes_out = zipped.size()
                 finish_task('mbtiles',[zipped])
             except Exception as ex :
                 stop_task('mbtiles')
@@ -726,7 +759,9 @@ def run_task(run_uid,run,stage_dir,download_dir):
         if 'bundle' in export_formats:
             start_task('bundle')
             try:
-                zipped = create_posm_bundle(join(download_dir,valid_name + '-bundle.tar.gz'),bundle_files,job.name,valid_name,job.description,geom)
+                with stages.stage('package:bundle') as stage:
+                    zipped = create_posm_bundle(join(download_dir,valid_name + '-bundle.tar.gz'),bundle_files,job.name,valid_name,job.description,geom)
+                    stage.bytes_out = zipped.size()
                 finish_task('bundle',[zipped])
             except Exception as ex :
                 stop_task('bundle')
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from shapely.geometry import LineString, Point, box
+
+from tasks.clipping import GridClip
+
+
+class TestGridClip(unittest.TestCase):
+
+    def test_matches_full_intersection(self):
+        aoi = Point(0, 0).buffer(1).difference(Point(0.2, 0).buffer(0.3))
+        clip = GridClip(aoi, size=8)
+        features = [
+            LineString([(-2, 0.5), (2, 0.5)]),
+            LineString([(0.9, 0.1), (1.1, 0.1)]),
+            LineString([(0.1, -0.1), (0.4, 0.1)]),
+            box(-1.5, -1.5, -0.5, -0.5),
+            box(0.95, -0.05, 3, 0.05),
+        ]
+        for f in features:
+            expected = aoi.intersection(f)
+            result = clip.intersection(f)
+            self.assertAlmostEqual(result.length, expected.length)
+            self.assertAlmostEqual(result.area, expected.area)
+        self.assertTrue(clip)
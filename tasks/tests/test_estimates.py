@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from mock import patch
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from feature_selection.feature_selection import FeatureSelection
+from jobs.models import Job, extent_nodes
+from tasks.estimates import MIN_SAMPLES, ONDEMAND_TIME_LIMIT, estimate_export, fit, format_models, predict
+from tasks.models import ExportRun, ExportTask
+
+MODELS = {'shp': {'size': (1000.0, 2.0), 'duration': (60.0, 0.0)}}
+
+
+class TestEstimates(SimpleTestCase):
+
+    def setUp(self):
+        self.geom = Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752))
+        self.geom.srid = 4326
+
+    def test_fit_and_predict(self):
+        model = fit([1, 2, 3], [12, 14, 16])
+        self.assertAlmostEqual(model[0], 10)
+        self.assertAlmostEqual(model[1], 2)
+        self.assertEqual(predict(model, 10), 30)
+        # a single node count can't give a slope
+        self.assertEqual(fit([5, 5], [10, 20]), (15.0, 0.0))
+        self.assertEqual(predict((-100.0, 1.0), 10), 0)
+
+    @patch('tasks.estimates.format_models', return_value=MODELS)
+    def test_estimate_export(self, format_models):
+        result = estimate_export(self.geom, ['shp', 'geojson'])
+        bbox_nodes = extent_nodes(self.geom.transform(3857, clone=True).extent)
+        self.assertEqual(result['formats']['shp'], {
+            'size_bytes': predict(MODELS['shp']['size'], bbox_nodes),
+            'duration_seconds': 60,
+        })
+        # no history for geojson: left out of the totals
+        self.assertEqual(result['formats']['geojson'], {'size_bytes': None, 'duration_seconds': None})
+        self.assertEqual(result['size_bytes'], result['formats']['shp']['size_bytes'])
+        self.assertEqual(result['duration_seconds'], 60)
+        self.assertEqual(result['queue'], 'default')
+        self.assertIsNone(result['tile_count'])
+
+    @patch('tasks.estimates.format_models', return_value={'mbtiles': {'size': (0.0, 0.0), 'duration': (ONDEMAND_TIME_LIMIT, 0.0)}})
+    def test_estimate_mbtiles(self, format_models):
+        result = estimate_export(self.geom, ['mbtiles'], 10, 12)
+        self.assertGreater(result['tile_count'], 0)
+        self.assertEqual(result['queue'], 'scheduled')
+
+    @patch('tasks.estimates.format_models', return_value={})
+    def test_no_history(self, format_models):
+        result = estimate_export(self.geom, ['shp'])
+        self.assertIsNone(result['size_bytes'])
+        self.assertIsNone(result['queue'])
+
+
+class TestFormatModels(TestCase):
+
+    def setUp(self):
+        format_models.cache_clear()
+        user = User.objects.create(username='user1', email='user1@demo.com', password='demo')
+        job = Job.objects.create(
+            name='TestJob',
+            user=user,
+            the_geom=Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)),
+            export_formats=['shp', 'geojson'],
+            feature_selection=FeatureSelection.example('simple')
+        )
+        run = ExportRun.objects.create(job=job, user=user)
+        now = timezone.now()
+        for name in ('shp', 'geojson'):
+            for i in range(MIN_SAMPLES + 1):
+                ExportTask.objects.create(
+                    run=run, name=name, status='SUCCESS', filesize_bytes=1000 + i,
+                    started_at=now, finished_at=now + datetime.timedelta(seconds=60)
+                )
+
+    def tearDown(self):
+        format_models.cache_clear()
+
+    @patch('tasks.estimates.fit', wraps=fit)
+    def test_one_model_per_format(self, wrapped_fit):
+        models = format_models()
+        self.assertEqual(set(models), {'shp', 'geojson'})
+        # a size and a duration fit for each format, not for each task
+        self.assertEqual(wrapped_fit.call_count, 4)
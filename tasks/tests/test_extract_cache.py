@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import shutil
+import time
+import unittest
+from unittest import mock
+
+from shapely.geometry import box
+
+from tasks.extract_cache import ENTRY_MODE, ExtractCache, extract_key, extract_meta, update_extracts
+
+
+class TestExtractCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ExtractCache(os.path.join(self.tmp.name, 'cache'), 10)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_extract_key(self):
+        geom = box(0, 0, 1, 1)
+        self.assertEqual(extract_key(geom, 'a', 1), extract_key(geom, 'a', 1))
+        self.assertNotEqual(extract_key(geom, 'a', 1), extract_key(geom, 'a', 2))
+        self.assertNotEqual(extract_key(geom, 'a', 1), extract_key(geom, 'b', 1))
+        self.assertNotEqual(extract_key(geom), extract_key(box(0, 0, 2, 2)))
+
+    def test_get_put(self):
+        out = os.path.join(self.tmp.name, 'out.osm.pbf')
+        self.assertFalse(self.cache.get('k', out))
+        self.cache.put('k', self.write('src.osm.pbf', b'12345'))
+        self.assertTrue(self.cache.get('k', out))
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), b'12345')
+
+    def test_entry_mode(self):
+        src = self.write('src.osm.pbf', b'12345')
+        os.chmod(src, 0o600)
+        self.cache.put('k', src)
+        self.assertEqual(os.stat(self.cache.path('k')).st_mode & 0o777, ENTRY_MODE)
+        out = os.path.join(self.tmp.name, 'out.osm.pbf')
+        self.cache.get('k', out)
+        # what run_task does to the osm_pbf output leaves the cached file alone
+        os.chmod(out, 0o644)
+        self.assertEqual(os.stat(self.cache.path('k')).st_mode & 0o777, ENTRY_MODE)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', self.write('a', b'12345'))
+        os.utime(self.cache.path('a'), (time.time() - 100, time.time() - 100))
+        self.cache.put('b', self.write('b', b'12345'))
+        self.cache.put('c', self.write('c', b'12345'))
+        self.assertFalse(os.path.exists(self.cache.path('a')))
+        self.assertTrue(os.path.exists(self.cache.path('c')))
+
+    def test_meta_sidecar(self):
+        geom = box(0, 0, 1, 1)
+        self.cache.put('k', self.write('src', b'1'), extract_meta(geom, None, 42))
+        meta = self.cache.meta('k')
+        self.assertEqual(meta['sequence'], '42')
+        self.assertEqual(meta['geometry'], geom.wkb_hex)
+        self.cache.remove('k')
+        self.assertIsNone(self.cache.meta('k'))
+        self.assertFalse(os.path.exists(self.cache.path('k')))
+
+
+def fake_osmium(cmd):
+    # apply-changes and extract: copy the input to -o
+    source = cmd[2] if cmd[1] == 'apply-changes' else cmd[cmd.index('-o') - 1]
+    shutil.copyfile(source, cmd[cmd.index('-o') + 1])
+
+
+class TestUpdateExtracts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ExtractCache(os.path.join(self.tmp.name, 'cache'), 1000)
+        self.geom = box(0, 0, 1, 1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def put(self, feature_selection, generation):
+        src = os.path.join(self.tmp.name, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'12345')
+        key = extract_key(self.geom, feature_selection, 1)
+        self.cache.put(key, src, extract_meta(self.geom, feature_selection, 1, generation))
+        return key
+
+    def update(self):
+        with mock.patch('tasks.extract_cache.get_cache', return_value=self.cache), \
+                mock.patch('tasks.extract_cache.subprocess.check_call', side_effect=fake_osmium):
+            return update_extracts(os.path.join(self.tmp.name, 'changes.osc.gz'), 1, 2, max_generations=2)
+
+    def test_rolls_forward_unfiltered(self):
+        key = self.put(None, 0)
+        self.assertEqual(self.update(), 1)
+        self.assertIsNone(self.cache.meta(key))
+        meta = self.cache.meta(extract_key(self.geom, None, 2))
+        self.assertEqual(meta['sequence'], '2')
+        self.assertEqual(meta['generation'], 1)
+
+    def test_drops_filtered(self):
+        key = self.put('buildings:\n  select:\n    - building\n', 0)
+        self.assertEqual(self.update(), 0)
+        self.assertIsNone(self.cache.meta(key))
+        self.assertEqual(list(self.cache.entries()), [])
+
+    def test_drops_after_max_generations(self):
+        key = self.put(None, 2)
+        self.assertEqual(self.update(), 0)
+        self.assertIsNone(self.cache.meta(key))
+        self.assertIsNone(self.cache.meta(extract_key(self.geom, None, 2)))
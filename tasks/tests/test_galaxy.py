@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from tasks.galaxy import convert_extract, feature_layers, OGR_FORMATS, SINGLE_EXTRACT_FORMATS
+
+
+def make_gpkg(path, layers):
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE gpkg_contents (table_name TEXT, data_type TEXT)")
+        conn.executemany("INSERT INTO gpkg_contents VALUES (?,?)", [(layer, 'features') for layer in layers])
+
+
+def fake_ogr2ogr(cmd):
+    # write the destination so it gets packaged
+    with open(cmd[-3], 'w') as f:
+        f.write('')
+
+
+class TestGalaxySingleExtract(unittest.TestCase):
+
+    def test_feature_layers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'extract.gpkg')
+            make_gpkg(path, ['buildings_polygons', 'roads_lines'])
+            with sqlite3.connect(path) as conn:
+                conn.execute("INSERT INTO gpkg_contents VALUES ('tiles','tiles')")
+            self.assertEqual(feature_layers(path), ['buildings_polygons', 'roads_lines'])
+
+    def test_single_extract_formats(self):
+        self.assertIn('geopackage', SINGLE_EXTRACT_FORMATS)
+        self.assertNotIn('fgb', SINGLE_EXTRACT_FORMATS)
+        self.assertNotIn('csv', SINGLE_EXTRACT_FORMATS)
+
+    def test_convert_extract(self):
+        expected = {
+            'shp': ['ogr2ogr', '-f', 'ESRI Shapefile', '{out}/buildings_polygons.shp', '{gpkg}', 'buildings_polygons'],
+            'kml': ['ogr2ogr', '-f', 'KML', '{out}/buildings_polygons.kml', '{gpkg}', 'buildings_polygons'],
+            'geojson': ['ogr2ogr', '-f', 'GeoJSON', '{out}/buildings_polygons.geojson', '{gpkg}', 'buildings_polygons'],
+        }
+        self.assertEqual(set(expected), set(OGR_FORMATS))
+        for output_name, cmd in expected.items():
+            with tempfile.TemporaryDirectory() as tmp:
+                gpkg = os.path.join(tmp, 'extract.gpkg')
+                make_gpkg(gpkg, ['buildings_polygons'])
+                stage_dir = os.path.join(tmp, 'stage')
+                download_dir = os.path.join(tmp, 'download')
+                os.makedirs(stage_dir)
+                os.makedirs(download_dir)
+                r = {'file_name': 'hot_dakar_buildings_gpkg.zip', 'theme': 'buildings'}
+                with mock.patch('tasks.galaxy.subprocess.check_call', side_effect=fake_ogr2ogr) as check_call:
+                    files = convert_extract([(r, [gpkg])], output_name, stage_dir, download_dir,
+                                            add_metadata=lambda z, theme: z.writestr('README.txt', theme))
+                name = 'hot_dakar_buildings_' + output_name
+                out = os.path.join(stage_dir, name)
+                check_call.assert_called_once_with([part.format(out=out, gpkg=gpkg) for part in cmd])
+                self.assertEqual(len(files), 1)
+                self.assertEqual(files[0].parts, [os.path.join(download_dir, name + '.zip')])
+                self.assertEqual(files[0].extra, {'theme': 'buildings'})
+                with zipfile.ZipFile(files[0].parts[0]) as z:
+                    self.assertEqual(z.namelist(), ['README.txt', 'buildings_polygons.' + OGR_FORMATS[output_name][1]])
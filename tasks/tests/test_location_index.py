@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+from collections import namedtuple
+from unittest import mock
+
+from tasks.location_index import choose_index
+
+Memory = namedtuple('Memory', 'available')
+
+
+class TestChooseIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'extract.osm.pbf')
+        with open(self.path, 'wb') as f:
+            f.write(b'0' * 8000)  # about 1000 nodes
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def choose(self, available, nodes=1000, max_id=10 ** 10):
+        with mock.patch('psutil.virtual_memory', return_value=Memory(available)), \
+                mock.patch('tasks.location_index.node_stats', return_value=(nodes, max_id)):
+            return choose_index(self.path, self.tmp.name)
+
+    def test_small_extract_in_memory(self):
+        self.assertEqual(self.choose(10 ** 9), 'flex_mem')
+
+    def test_large_extract_file_backed(self):
+        self.assertTrue(self.choose(1000).startswith('sparse_file_array,'))
+        self.assertTrue(self.choose(1000, max_id=1500).startswith('dense_file_array,'))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import datetime
+from collections import namedtuple
+
+from mock import MagicMock, patch
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from feature_selection.feature_selection import FeatureSelection
+from jobs.models import Job
+from tasks.metrics import LAG, collect, fold_finished, inc, new_state, observe, render
+from tasks.models import ExportRun
+
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+
+class TestMetrics(SimpleTestCase):
+
+    def test_render_histogram_and_counter(self):
+        state = {'histograms': {}, 'counters': {}}
+        observe(state, 'export_task_duration_seconds', {'format': 'shp'}, 3)
+        observe(state, 'export_task_duration_seconds', {'format': 'shp'}, 100)
+        inc(state, 'export_output_bytes_total', {'format': 'shp'}, 10)
+        text = render(state, [('export_worker_processes', [({}, 2)])])
+        self.assertIn('export_task_duration_seconds_bucket{format="shp",le="1"} 0', text)
+        self.assertIn('export_task_duration_seconds_bucket{format="shp",le="5"} 1', text)
+        self.assertIn('export_task_duration_seconds_bucket{format="shp",le="+Inf"} 2', text)
+        self.assertIn('export_task_duration_seconds_sum{format="shp"} 103', text)
+        self.assertIn('export_output_bytes_total{format="shp"} 10', text)
+        self.assertIn('# TYPE export_worker_processes gauge\nexport_worker_processes 2', text)
+
+
+class TestCollect(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user1', email='user1@demo.com', password='demo')
+        self.job = Job.objects.create(
+            name='TestJob',
+            user=self.user,
+            the_geom=Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)),
+            export_formats=['shp'],
+            feature_selection=FeatureSelection.example('simple')
+        )
+
+    def run_with(self, status, **kwargs):
+        return ExportRun.objects.create(job=self.job, user=self.user, status=status, **kwargs)
+
+    def test_fold_finished(self):
+        now = timezone.now()
+        for status in ('COMPLETED', 'COMPLETED', 'COMPLETED', 'FAILED'):
+            self.run_with(status, started_at=now - datetime.timedelta(seconds=50), finished_at=now - LAG / 2)
+        state = new_state()
+        fold_finished(state, now)
+        counters = state['counters']['export_runs_total']
+        self.assertEqual(sorted((s['labels']['status'], s['value']) for s in counters.values()),
+            [('COMPLETED', 3), ('FAILED', 1)])
+        durations = list(state['histograms']['export_run_duration_seconds'].values())
+        self.assertEqual([s['count'] for s in durations], [4])
+        self.assertEqual(state['finished_until'], now.isoformat())
+
+    @patch('tasks.metrics.shutil.disk_usage', return_value=DiskUsage(100, 50, 50))
+    @patch('tasks.metrics.psutil.cpu_percent', return_value=10.0)
+    @patch('tasks.metrics.worker_processes', return_value=[])
+    @patch('tasks.metrics.redis_client')
+    def test_runs_in_progress(self, redis_client, worker_processes, cpu_percent, disk_usage):
+        redis_client.return_value = MagicMock(**{'get.return_value': None, 'llen.return_value': 0, 'zcard.return_value': 0})
+        for status in ('RUNNING', 'RUNNING', 'RUNNING', 'SUBMITTED', 'SUBMITTED'):
+            self.run_with(status)
+        lines = [line for line in collect().splitlines() if line.startswith('export_runs_in_progress')]
+        # one series per status, not one per run
+        self.assertEqual(sorted(lines), [
+            'export_runs_in_progress{status="RUNNING"} 3',
+            'export_runs_in_progress{status="SUBMITTED"} 2',
+        ])
@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
+import importlib
+import io
 import uuid
 
 from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
 from django.utils import timezone
 import datetime
 
-from jobs.models import Job
+from api.serializers import ExportRunSerializer
+from jobs.models import HDXExportRegion, Job
 from feature_selection.feature_selection import FeatureSelection
 
-from ..models import ExportRun, ExportTask
+from ..models import ExportRun, ExportRunStage, ExportTask
 
 class TestExportRunAndTask(TestCase):
     """
@@ -88,5 +93,110 @@ class TestExportRunAndTask(TestCase):
         self.assertEqual(list(task.download_urls)[0]['download_url'],root+str(run.uid)+'/'+'a_filename')
         self.assertEqual(list(task.download_urls)[0]['filename'],'a_filename')
 
+    def test_long_stage_detail(self):
+        run = ExportRun.objects.create(job=self.job, user=self.user1)
+        # the per-tile summary of a parallel apply_file
+        detail = '64 tiles: ' + ', '.join(['flex_mem x1'] * 64)
+        ExportRunStage.objects.create(run=run, name='apply_file', duration=1, detail=detail)
+        self.assertEqual(run.stages.get().detail, detail)
 
 
+
+
+
+class TestJobLatestRuns(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user1', email='user1@demo.com', password='demo')
+        self.job = Job.objects.create(
+            name='TestJob',
+            user=self.user,
+            the_geom=Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)),
+            export_formats=['shp'],
+            feature_selection=FeatureSelection.example('simple')
+        )
+
+    def pointers(self):
+        job = Job.objects.get(id=self.job.id)
+        return job.latest_run_id, job.latest_finished_run_id
+
+    def finish(self, run, filesize):
+        now = timezone.now()
+        ExportTask.objects.create(run=run, name='shp', filesize_bytes=filesize)
+        run.started_at = now
+        run.finished_at = now + datetime.timedelta(0,50)
+        run.status = 'COMPLETED'
+        run.save()
+
+    def test_run_created_finished_deleted(self):
+        self.assertEqual(self.pointers(), (None, None))
+        run1 = ExportRun.objects.create(job=self.job, user=self.user)
+        self.assertEqual(self.pointers(), (run1.id, None))
+        self.finish(run1, 100)
+        self.assertEqual(self.pointers(), (run1.id, run1.id))
+        run2 = ExportRun.objects.create(job=self.job, user=self.user)
+        self.assertEqual(self.pointers(), (run2.id, run1.id))
+        run2.delete()
+        self.assertEqual(self.pointers(), (run1.id, run1.id))
+        run1.delete()
+        self.assertEqual(self.pointers(), (None, None))
+
+    def test_last_size_reads_pointers(self):
+        region = HDXExportRegion.objects.create(job=self.job)
+        run1 = ExportRun.objects.create(job=self.job, user=self.user)
+        self.finish(run1, 100)
+        ExportRun.objects.create(job=self.job, user=self.user)
+        region = HDXExportRegion.objects.select_related(
+            'job__latest_run', 'job__latest_finished_run').get(id=region.id)
+        # the submitted run has no size yet, the finished one does
+        with self.assertNumQueries(2):
+            self.assertEqual(region.last_size, 100)
+
+    def test_backfill(self):
+        migration = importlib.import_module('jobs.migrations.0079_job_latest_runs').Migration
+        run1 = ExportRun.objects.create(job=self.job, user=self.user)
+        self.finish(run1, 100)
+        run2 = ExportRun.objects.create(job=self.job, user=self.user)
+        Job.objects.update(latest_run=None, latest_finished_run=None)
+        with connection.cursor() as cursor:
+            cursor.execute(migration.operations[-1].sql)
+        self.assertEqual(self.pointers(), (run2.id, run1.id))
+
+
+class TestExportRunSizes(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user1', email='user1@demo.com', password='demo')
+        job = Job.objects.create(
+            name='TestJob',
+            user=self.user,
+            the_geom=Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)),
+            export_formats=['shp', 'geojson'],
+            feature_selection=FeatureSelection.example('simple')
+        )
+        self.run = ExportRun.objects.create(job=job, user=self.user)
+
+    def test_finishing_tasks_stores_sizes(self):
+        ExportTask.objects.create(run=self.run, name='shp', status='SUCCESS', filesize_bytes=100)
+        self.run.save_sizes()
+        ExportTask.objects.create(run=self.run, name='geojson', status='SUCCESS', filesize_bytes=50)
+        self.run.save_sizes()
+
+        run = ExportRun.objects.get(id=self.run.id)
+        self.assertEqual(run.total_size, 150)
+        self.assertEqual(run.format_sizes, {'shp': 100, 'geojson': 50})
+        with self.assertNumQueries(0):
+            self.assertEqual(run.size, 150)
+
+        data = ExportRunSerializer(run).data
+        self.assertEqual(data['size'], 150)
+        self.assertEqual(data['format_sizes'], {'shp': 100, 'geojson': 50})
+
+    def test_backfill_run_sizes(self):
+        ExportTask.objects.create(run=self.run, name='shp', filesize_bytes=100)
+        ExportTask.objects.create(run=self.run, name='geojson')
+        self.assertIsNone(ExportRun.objects.get(id=self.run.id).total_size)
+        call_command('backfill_run_sizes', batch_size=1, stdout=io.StringIO())
+        run = ExportRun.objects.get(id=self.run.id)
+        self.assertEqual(run.total_size, 100)
+        self.assertEqual(run.format_sizes, {'shp': 100, 'geojson': 0})
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from tasks.parallel_tabular import TileGrid
+
+
+class TestTileGrid(unittest.TestCase):
+
+    def test_owner_tile_contains_location(self):
+        grid = TileGrid.covering((10, 20, 12, 21), 16)
+        self.assertEqual(len(grid), 16)
+        for lon, lat in [(10, 20), (11.5, 20.25), (12, 21), (-170, -80), (179, 89), (11, 20.5)]:
+            minx, miny, maxx, maxy = grid.bbox(grid.owner(lon, lat))
+            self.assertTrue(minx <= lon <= maxx and miny <= lat <= maxy)
+
+    def test_outer_tiles_reach_world_edges(self):
+        grid = TileGrid((0, 0, 1, 1), 2, 2)
+        self.assertEqual(grid.bbox(0)[:2], [-180.0, -90.0])
+        self.assertEqual(grid.bbox(3)[2:], [180.0, 90.0])
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import mercantile
+from shapely.geometry import box
+
+from tasks.planet_shards import descendants, shard_tiles, tile_bbox
+
+
+class TestPlanetShards(unittest.TestCase):
+
+    def test_edge_tiles_reach_the_poles(self):
+        self.assertEqual(tile_bbox(mercantile.Tile(0, 0, 1))[3], 90.0)
+        self.assertEqual(tile_bbox(mercantile.Tile(0, 1, 1))[1], -90.0)
+
+    def test_descendants(self):
+        tiles = descendants(mercantile.Tile(0, 0, 0), 3)
+        self.assertEqual(len(tiles), 64)
+        self.assertTrue(all(t.z == 3 for t in tiles))
+
+    def test_shard_tiles(self):
+        # a small box well inside one zoom 6 tile
+        self.assertEqual(shard_tiles(box(10.1, 50.1, 10.2, 50.2), 6), [mercantile.tile(10.15, 50.15, 6)])
+        self.assertEqual(len(shard_tiles(box(-1, -1, 1, 1), 6)), 4)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+from unittest import mock
+
+from tasks.prefilter import filter_expressions, prefilter, required_keys
+
+Theme = namedtuple('Theme', ['matcher', 'points', 'lines', 'polygons'])
+Matcher = namedtuple('Matcher', ['expr'])
+Mapping = namedtuple('Mapping', ['themes'])
+
+
+class TestPrefilter(unittest.TestCase):
+
+    def test_required_keys(self):
+        self.assertEqual(required_keys(('or', ('notnull', 'amenity'), ('=', 'shop', 'bakery'))), {'amenity', 'shop'})
+        self.assertEqual(required_keys(('and', ('notnull', 'building'), ('in', 'amenity', ['school', 'college']))), {'building'})
+        self.assertEqual(required_keys(('and', ('!=', 'access', 'private'), ('notnull', 'highway'))), {'highway'})
+        self.assertIsNone(required_keys(('or', ('!=', 'access', 'private'), ('notnull', 'highway'))))
+        self.assertEqual(required_keys(()), set())
+
+    def test_filter_expressions(self):
+        mapping = Mapping([
+            Theme(Matcher(('notnull', 'amenity')), True, False, True),
+            Theme(Matcher(('=', 'highway', 'primary')), False, True, False),
+        ])
+        self.assertEqual(filter_expressions(mapping), ['n/amenity', 'r/amenity', 'w/amenity,highway'])
+
+    def test_no_filter(self):
+        mapping = Mapping([
+            Theme(Matcher(('notnull', 'amenity')), True, False, False),
+            Theme(Matcher(('!=', 'highway', 'primary')), False, True, False),
+        ])
+        self.assertIsNone(filter_expressions(mapping))
+        self.assertIsNone(filter_expressions(Mapping([Theme(Matcher(('notnull', 'name:*')), True, False, False)])))
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'prefilter.osm.pbf')
+
+# the fixture has a cafe, a bench, a building way, a highway, a stream
+# and a building multipolygon whose outer way is untagged
+FIXTURE_MAPPING = """
+amenities:
+    types:
+        - points
+    select:
+        - amenity
+        - name
+    where: amenity IS NOT NULL
+roads:
+    types:
+        - lines
+    select:
+        - highway
+    where: highway IS NOT NULL
+buildings:
+    types:
+        - polygons
+    select:
+        - building
+    where: building IS NOT NULL
+"""
+
+
+class Recorder(object):
+    def __init__(self):
+        self.features = set()
+
+    def write(self, osm_id, layer_name, geom_type, geom, tags):
+        self.features.add((osm_id, layer_name, geom_type, geom.ExportToWkt()))
+
+
+@unittest.skipUnless(shutil.which('osmium'), 'needs osmium-tool')
+class TestPrefilterFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.tmp.name, 'tabular.osm.pbf')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def features(self, path, mapping):
+        import osm_export_tool.tabular as tabular
+        recorder = Recorder()
+        tabular.Handler([recorder], mapping).apply_file(path, locations=True)
+        return recorder.features
+
+    def test_same_features(self):
+        from osm_export_tool.mapping import Mapping
+        mapping = Mapping(FIXTURE_MAPPING)
+        with mock.patch('tasks.prefilter.MAX_SHARE', 10):
+            path = prefilter(FIXTURE, mapping, self.output)
+        self.assertEqual(path, self.output)
+        expected = self.features(FIXTURE, mapping)
+        self.assertEqual({(f[0], f[1]) for f in expected}, {
+            (1, 'amenities'), (101, 'roads'), (100, 'buildings'), (-200, 'buildings')})
+        self.assertEqual(self.features(path, mapping), expected)
+
+    def test_rejected_output_is_removed(self):
+        from osm_export_tool.mapping import Mapping
+        with mock.patch('tasks.prefilter.MAX_SHARE', 0):
+            path = prefilter(FIXTURE, Mapping(FIXTURE_MAPPING), self.output)
+        self.assertEqual(path, FIXTURE)
+        self.assertFalse(os.path.exists(self.output))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon
+from django.test import TestCase
+from django.utils import timezone
+
+from jobs.models import Job
+from feature_selection.feature_selection import FeatureSelection
+
+from tasks.models import DailyStats
+from tasks.rollups import daily_stats
+
+
+class TestDailyStats(TestCase):
+
+    def setUp(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        # three whole days well in the past
+        self.day1 = today - timedelta(days=10)
+        self.day2 = self.day1 + timedelta(days=1)
+        self.day3 = self.day2 + timedelta(days=1)
+        self.user = User.objects.create(username='demo', email='demo@demo.com', password='demo',
+                                        date_joined=self.day1 - timedelta(days=1))
+
+    def job(self, created_at):
+        return Job.objects.create(
+            name='TestJob',
+            user=self.user,
+            the_geom=Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)),
+            export_formats=['shp'],
+            feature_selection=FeatureSelection.example('simple'),
+            created_at=created_at,
+        )
+
+    def jobs_count(self, days):
+        return sum(stats['jobs_count'] for stats in days.values())
+
+    def test_partial_days_at_both_ends(self):
+        hour = timedelta(hours=1)
+        for t in (self.day1 + 10 * hour, self.day1 + 13 * hour, self.day2 + 12 * hour,
+                  self.day3 + 11 * hour, self.day3 + 13 * hour):
+            self.job(t)
+        days = daily_stats(self.day1 + 12 * hour, self.day3 + 12 * hour)
+        self.assertEqual(self.jobs_count(days), 3)
+        self.assertEqual(days[self.day2.date()]['jobs_count'], 1)
+        # only the whole day in between is stored
+        self.assertEqual(list(DailyStats.objects.values_list('day', flat=True)), [self.day2.date()])
+
+    def test_non_utc_bounds(self):
+        self.job(self.day2 + timedelta(hours=1))
+        tz = timezone.get_fixed_timezone(120)
+        # 02:30 local is 00:30 UTC: the job at 01:00 UTC is inside
+        after = (self.day2 + timedelta(minutes=30)).astimezone(tz)
+        self.assertEqual(self.jobs_count(daily_stats(after, self.day3.astimezone(tz))), 1)
+        after = (self.day2 + timedelta(hours=1, minutes=30)).astimezone(tz)
+        self.assertEqual(self.jobs_count(daily_stats(after, self.day3.astimezone(tz))), 0)
+
+    def test_range_including_today(self):
+        self.job(self.day2 + timedelta(hours=12))
+        self.job(timezone.now() - timedelta(seconds=1))
+        days = daily_stats(self.day1, timezone.now() + timedelta(hours=1))
+        self.assertEqual(self.jobs_count(days), 2)
+        today = timezone.now().date()
+        self.assertFalse(DailyStats.objects.filter(day=today).exists())
+        self.assertTrue(DailyStats.objects.filter(day=self.day2.date()).exists())
+
+    def test_stale_row_is_recomputed(self):
+        self.job(self.day2 + timedelta(hours=12))
+        self.assertEqual(self.jobs_count(daily_stats(self.day2, self.day3)), 1)
+        # saving a job marks its day stale
+        self.job(self.day2 + timedelta(hours=13))
+        self.assertTrue(DailyStats.objects.get(day=self.day2.date()).stale)
+        self.assertEqual(self.jobs_count(daily_stats(self.day2, self.day3)), 2)
+        self.assertFalse(DailyStats.objects.get(day=self.day2.date()).stale)
+
+    def test_login_does_not_mark_stale(self):
+        daily_stats(self.day1 - timedelta(days=1), self.day1)
+        row = DailyStats.objects.get(day=(self.day1 - timedelta(days=1)).date())
+        self.assertEqual(row.stats['users_count'], 1)
+        self.user.last_login = timezone.now()
+        self.user.save()
+        self.assertFalse(DailyStats.objects.get(id=row.id).stale)
+        User.objects.create(username='other', date_joined=self.day1 - timedelta(hours=1))
+        self.assertTrue(DailyStats.objects.get(id=row.id).stale)
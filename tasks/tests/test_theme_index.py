@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import unittest
+from collections import namedtuple
+
+from osm_export_tool import GeomType
+from osm_export_tool.mapping import Mapping
+
+from tasks.theme_index import ThemeIndex
+
+Tag = namedtuple('Tag', ['k', 'v'])
+
+
+class Tags(dict):
+    # iterates like an osmium TagList
+    def __iter__(self):
+        return iter([Tag(k, v) for k, v in self.items()])
+
+
+MAPPING = '''
+buildings:
+    types:
+        - polygons
+    select:
+        - building
+    where: building IS NOT NULL
+roads:
+    types:
+        - lines
+    select:
+        - highway
+    where: highway IN ('primary','secondary') AND access != 'private'
+public:
+    types:
+        - points
+        - lines
+    select:
+        - name
+    where: access != 'private'
+'''
+
+
+class TestThemeIndex(unittest.TestCase):
+
+    def test_matches_every_theme(self):
+        mapping = Mapping(MAPPING)
+        index = ThemeIndex(mapping)
+        objects = [
+            Tags(building='yes'),
+            Tags(highway='primary'),
+            Tags(highway='primary', access='private'),
+            Tags(highway='residential', name='x'),
+            Tags(access='private'),
+            Tags(source='survey'),
+        ]
+        for tags in objects:
+            for geom_type in GeomType:
+                expected = [t.name for t in mapping.themes if t.matches(geom_type, tags)]
+                index.select(geom_type, tags)
+                self.assertEqual([t.name for t in index.themes if t.matches(geom_type, tags)], expected)
+
+    def test_no_candidates(self):
+        index = ThemeIndex(Mapping(MAPPING))
+        self.assertFalse(index.select(GeomType.POLYGON, Tags(highway='primary')))
+        self.assertTrue(index.select(GeomType.POINT, Tags(source='survey')))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Theme matching indexed by tag key.
+
+tabular.Handler tests each object against every theme's where clause in
+turn, though most objects carry none of the keys those clauses look at.
+ThemeIndex maps each key to the themes whose clause needs it (see
+prefilter.required_keys), so an object is only tested against the themes
+for keys it has, plus any whose clause can match without a particular key.
+"""
+from osm_export_tool import GeomType
+import osm_export_tool.tabular as tabular
+
+from .prefilter import required_keys
+
+
+def geom_types(theme):
+    return [geom_type for geom_type, wanted in (
+        (GeomType.POINT, theme.points),
+        (GeomType.LINE, theme.lines),
+        (GeomType.POLYGON, theme.polygons),
+    ) if wanted]
+
+
+class ThemeIndex(object):
+    """Stands in for the Mapping in IndexedHandler; themes are the candidates from the last select()."""
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.themes = []
+        self.keyless = {geom_type: set() for geom_type in GeomType}
+        self.by_key = {geom_type: {} for geom_type in GeomType}
+        for i, theme in enumerate(mapping.themes):
+            keys = required_keys(theme.matcher.expr)
+            for geom_type in geom_types(theme):
+                if keys is None:
+                    self.keyless[geom_type].add(i)
+                    continue
+                for key in keys:
+                    self.by_key[geom_type].setdefault(key, set()).add(i)
+
+    def select(self, geom_type, tags):
+        """Set themes to those that may match tags as geom_type; False if there are none."""
+        by_key = self.by_key[geom_type]
+        found = set(self.keyless[geom_type])
+        for tag in tags:
+            if tag.k in by_key:
+                found |= by_key[tag.k]
+        # in mapping order, like the full list
+        self.themes = [self.mapping.themes[i] for i in sorted(found)]
+        return bool(found)
+
+
+class IndexedHandler(tabular.Handler):
+    """tabular.Handler that only tests objects against the themes for their keys."""
+
+    def __init__(self, outputs, mapping, clipping_geom=None, polygon_centroid=False):
+        super(IndexedHandler, self).__init__(outputs, mapping, clipping_geom=clipping_geom, polygon_centroid=polygon_centroid)
+        self.mapping = ThemeIndex(mapping)
+
+    def node(self, n):
+        if self.mapping.select(GeomType.POINT, n.tags):
+            super(IndexedHandler, self).node(n)
+
+    def way(self, w):
+        if self.mapping.select(GeomType.LINE, w.tags):
+            super(IndexedHandler, self).way(w)
+
+    def area(self, a):
+        if self.mapping.select(GeomType.POLYGON, a.tags):
+            super(IndexedHandler, self).area(a)
@@ -1,5 +1,8 @@
+import math
+
 from django.contrib.gis.geos import GEOSGeometry, Polygon
-from django.contrib.gis.geos.prototypes.io import wkt_w
+from django.contrib.gis.geos.prototypes.io import wkb_w
+import shapely.wkb
 
 # goals:
 # for clipping efficiency, we want a < 500 point geometry.
@@ -13,20 +16,47 @@ from django.contrib.gis.geos.prototypes.io import wkt_w
 
 def force2d(geom):
     # force geom to be 2d: https://groups.google.com/forum/#!topic/django-users/7c1NZ76UwRU
-    wkt = wkt_w(dim=2).write(geom).decode()
-    return GEOSGeometry(wkt)
+    return GEOSGeometry(wkb_w(dim=2).write(geom), srid=geom.srid)
+
+def to_shapely(geom):
+    """A GEOS geometry as a shapely one, passed as WKB so coordinates are exact."""
+    return shapely.wkb.loads(bytes(geom.wkb))
+
+MAX_COORDS = 500
+# degrees; the search for a tolerance meeting the budget stays between these
+MIN_TOLERANCE = 0.000001
+MAX_TOLERANCE = 10.0
+SEARCH_PASSES = 10
+
+def simplify_to(geom, max_coords=MAX_COORDS, passes=SEARCH_PASSES):
+    """
+    Simplify geom to at most max_coords with close to the smallest tolerance
+    that gets there, bisecting the exponent between MIN_TOLERANCE and
+    MAX_TOLERANCE. Every pass simplifies geom itself, so errors don't add up,
+    and there are at most passes + 1 of them. A geometry that can't reach
+    the budget (e.g. too many polygons) returns the coarsest result.
+    """
+    if geom.num_coords <= max_coords:
+        return geom
+    result = geom.simplify(MAX_TOLERANCE, preserve_topology=True)
+    if result.num_coords > max_coords:
+        return result
+    lower, upper = math.log(MIN_TOLERANCE), math.log(MAX_TOLERANCE)
+    for _ in range(passes):
+        middle = (lower + upper) / 2
+        candidate = geom.simplify(math.exp(middle), preserve_topology=True)
+        if candidate.num_coords <= max_coords:
+            upper, result = middle, candidate
+        else:
+            lower = middle
+    return result
 
 def simplify_geom(geom,force_buffer=False, preserve_geom=False):
     if preserve_geom is False:
         if geom.num_coords > 10000:
             geom = geom.simplify(0.01)
-        if geom.num_coords > 500:
-            geom = geom.buffer(0.02)
-        param = 0.01
-        while geom.num_coords > 500:
-            geom = geom.simplify(param, preserve_topology=True)
-            param = param * 2
+        if geom.num_coords > MAX_COORDS:
+            geom = simplify_to(geom.buffer(0.02))
     if force_buffer:
             geom = geom.buffer(0.02)
     return geom
-
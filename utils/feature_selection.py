@@ -0,0 +1,43 @@
+import hashlib
+import threading
+
+import yaml
+from cachetools import LRUCache
+from django.utils.functional import cached_property
+from osm_export_tool.mapping import InvalidMapping, Mapping
+
+# distinct feature selections kept parsed; most jobs share a handful of them
+MAX_MAPPINGS = 128
+
+class CompiledMapping(Mapping):
+    """
+    A Mapping plus the SQL criteria of each theme, written into READMEs
+    and HDX notes. Shared between callers, so never modified once built.
+    """
+
+    @cached_property
+    def criteria(self):
+        # to_sql fails on the empty matcher of a theme with no select or where
+        return {theme.name: theme.matcher.to_sql() if theme.matcher.expr else '' for theme in self.themes}
+
+_mappings = LRUCache(maxsize=MAX_MAPPINGS)
+_lock = threading.Lock()
+
+def compiled_mapping(feature_selection):
+    """The CompiledMapping of a feature selection's YAML, parsed once per process."""
+    key = hashlib.sha1(feature_selection.encode('utf-8')).hexdigest()
+    with _lock:
+        mapping = _mappings.get(key)
+    if mapping is None:
+        # parse outside the lock; two threads racing on the same text just build it twice
+        mapping = CompiledMapping(feature_selection)
+        with _lock:
+            _mappings[key] = mapping
+    return mapping
+
+def validate(feature_selection):
+    """(CompiledMapping, None), or (None, errors) like Mapping.validate."""
+    try:
+        return compiled_mapping(feature_selection), None
+    except (yaml.scanner.ScannerError, yaml.parser.ParserError, InvalidMapping) as e:
+        return None, [str(e)]
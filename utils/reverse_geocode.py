@@ -0,0 +1,20 @@
+import os
+
+from rtree import index
+
+# built from GeoNames cities1000 by jobs/parse_rtree.py
+INDEX_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api', 'reverse_geocode')
+
+_idx = None
+
+def nearest_place(x, y):
+    """[name, admin_1, country code] of the GeoNames place nearest a 4326 point; LookupError if there is none."""
+    global _idx
+    if _idx is None:
+        # Rtree would create an empty index in place of a missing one
+        if not os.path.isfile(INDEX_PATH + '.dat'):
+            raise LookupError('No reverse geocoding index at {0}'.format(INDEX_PATH))
+        _idx = index.Rtree(INDEX_PATH)
+    for item in _idx.nearest((x, y), 1, objects=True):
+        return item.object
+    raise LookupError('The reverse geocoding index is empty')
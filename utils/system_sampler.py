@@ -0,0 +1,42 @@
+"""
+CPU and memory use sampled by a background thread,
+so status endpoints read the last sample instead of blocking on psutil.cpu_percent.
+Each web worker process runs one sampler thread, started on its first request
+for a sample (see SYSTEM_SAMPLE_INTERVAL).
+"""
+import threading
+import time
+
+import psutil
+from django.conf import settings
+
+_lock = threading.Lock()
+_sampler = None
+_sample = {"cpu_percent": None, "ram_percent": None, "sampled_at": None}
+
+
+def _sample_forever():
+    # the first call only sets the baseline for the next one
+    psutil.cpu_percent(None)
+    while True:
+        time.sleep(settings.SYSTEM_SAMPLE_INTERVAL)
+        _sample.update(
+            cpu_percent=psutil.cpu_percent(None),
+            ram_percent=psutil.virtual_memory().percent,
+            sampled_at=time.time(),
+        )
+
+
+def latest_sample():
+    """
+    The latest sample; starts the sampler in this process on first use.
+    Values are None until the first interval has passed.
+    """
+    global _sampler
+    with _lock:
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = threading.Thread(
+                target=_sample_forever, name="system-sampler", daemon=True
+            )
+            _sampler.start()
+    return dict(_sample)